@@ -1,11 +1,125 @@
 import argparse
-import subprocess
+import importlib
 import os
 import shlex
+import subprocess
+import sys
+import time
+
+_LAUNCHED_AT = time.perf_counter()
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+LEVELS = ["level1", "level2", "level3"]
+LEVEL_GGUF_DIR = "/workspace/output/adapters_gguf/levels"
+
+# Set by --isolate: run every stage in its own python3 process instead of in-process
+ISOLATE = False
+# GPU training always gets a fresh process, so each level starts with empty CUDA memory
+SUBPROCESS_STAGES = {"train_lora"}
+# Set by --profile: stage_profiler.RunProfile recording every stage
+PROFILE = None
+
+def run(script, argv=None):
+    """Run a stage from app/scripts, in-process unless ISOLATE is set or it is a SUBPROCESS_STAGES one.
+
+    Stages without an argument parser are called as main(); stages with one
+    get an explicit argv list so they never read this process's sys.argv.
+    """
+    label = " ".join(shlex.quote(c) for c in [f"{script}.py"] + list(argv or []))
+    print(f"\n===== Running: {label} =====")
+
+    if PROFILE:
+        with PROFILE.stage(label):
+            _run(script, argv)
+    else:
+        _run(script, argv)
+
+def _run(script, argv):
+    if ISOLATE or script in SUBPROCESS_STAGES:
+        cmd = [sys.executable, os.path.join(SCRIPTS_DIR, f"{script}.py")] + list(argv or [])
+        subprocess.run(cmd, check=True)
+        return
+
+    start = time.perf_counter()
+    module = importlib.import_module(script)
+    now = time.perf_counter()
+    print(f"[startup] {script}: {now - _LAUNCHED_AT:.3f}s since launch "
+          f"(stage import {now - start:.3f}s)")
+
+    rc = module.main() if argv is None else module.main(list(argv))
+    if rc:
+        raise SystemExit(rc)
+
+def holdout_argv(args):
+    return [] if args.holdout_pct is None else ["--holdout-pct", str(args.holdout_pct)]
+
+def build_training_dataset(args):
+    """pdf_pretest + build_dataset, unless the last train_all already built it from the current uploads."""
+    import archive_manifest
+    import build_dataset
+
+    holdout = 0.0 if args.holdout_pct is None else args.holdout_pct
+    if archive_manifest.dataset_is_current(build_dataset.RAW_DIR, holdout):
+        print("\n===== Dataset already built from the current uploads by the last train_all; "
+              "skipping pdf_pretest and build_dataset =====")
+        return
+    run("pdf_pretest")
+    run("build_dataset", holdout_argv(args))
 
-def run(cmd):
-    print(f"\n===== Running: {cmd} =====")
-    subprocess.run(cmd, shell=True, check=True)
+def bench_argv(args):
+    """--bench-* options passed through to test_gguf/switch_adapter."""
+    cmd = []
+    for flag in ("threads", "ngl", "ctx", "repeats"):
+        value = getattr(args, f"bench_{flag}")
+        if value is not None:
+            cmd += [f"--bench-{flag}", str(value)]
+    return cmd
+
+def post_training_stages(base_gguf, holdout=()):
+    """Stages that follow training; only convert depends on the merged model.
+
+    After archiving, the dataset for the next train_all is built from whatever
+    was uploaded during this run.
+    """
+    from pipeline_scheduler import Stage
+
+    cpus = os.cpu_count() or 4
+    side_threads = max(1, cpus // 4)
+    main_threads = max(1, cpus - side_threads - 1)
+
+    stages = [
+        Stage("merge", "merge_lora", [], threads=main_threads),
+        Stage("convert", "convert_to_gguf", after=["merge"], threads=main_threads),
+    ]
+    # Side stages share one CPU budget, so they run one after another beside merge/convert;
+    # a group rather than a dependency, so one failed export does not skip the rest
+    for level in LEVELS:
+        stages.append(Stage(
+            f"export_{level}", "export_lora",
+            ["--single_adapter", f"/workspace/peft/{level}",
+             "--output_dir", LEVEL_GGUF_DIR, "--base_model", base_gguf],
+            threads=side_threads, group="side",
+        ))
+    stages += [
+        Stage("archive", "archive_used_pdfs", threads=1, mem_gb=1),
+        Stage("next_pretest", "pdf_pretest", after=["archive"], threads=side_threads, group="side"),
+        Stage("next_dataset", "build_dataset", list(holdout), after=["next_pretest"],
+              threads=side_threads, group="side"),
+    ]
+    return stages
+
+def run_post_training(args):
+    """Post-training stages always run as separate processes so they can overlap."""
+    from pipeline_scheduler import run_stages
+
+    print("\n===== Running post-training stages =====")
+    try:
+        run_stages(post_training_stages(args.base_gguf, holdout_argv(args)), max_workers=args.jobs, profile=PROFILE)
+    except RuntimeError as e:
+        print(f"\n✗ {e}")
+        raise SystemExit(1)
 
 def print_welcome_message():
     print("""
@@ -55,7 +169,10 @@ def main():
         "test_gguf",
         "export_adapters",
         "verify_adapters",
-        "switch_adapter"
+        "switch_adapter",
+        "catalog",
+        "blend_adapters",
+        "load_test"
     ], help="Action to perform")
     
     parser.add_argument("--model", help="Path to GGUF model for test_gguf mode", default="/workspace/models/mistral-7b-instruct-v0.2.Q4_K_M.gguf")
@@ -66,6 +183,31 @@ def main():
     parser.add_argument("--max-tokens", type=int, help="Max tokens for test_gguf mode")
     parser.add_argument("--temp", type=float, help="Temperature for test_gguf mode")
     parser.add_argument("--ngl", type=int, help="GPU offload layers for test_gguf mode")
+    parser.add_argument("--blend", nargs="+", metavar="PATH:WEIGHT", help="PEFT adapter folders and weights for blend_adapters mode")
+    parser.add_argument("--rank", type=int, help="Target rank for blend_adapters mode")
+    parser.add_argument("--backend", choices=["cli", "server"], help="Inference backend for test_gguf/switch_adapter (server = one llama-server for all adapters)")
+    parser.add_argument("--bench", action="store_true", help="Benchmark test_gguf/switch_adapter runs (tokens/s, TTFT, peak RSS; CPU-only by default)")
+    parser.add_argument("--bench-threads", help="Comma-separated thread counts for --bench, e.g. 4,8,16")
+    parser.add_argument("--bench-ngl", help="Comma-separated GPU offload layers for --bench, e.g. 0,20,35 (default 0: CPU only)")
+    parser.add_argument("--bench-ctx", help="Comma-separated context sizes for --bench")
+    parser.add_argument("--bench-repeats", type=int, help="Repeats of the prompt suite for --bench")
+    parser.add_argument("--url", help="Server base URL for load_test mode (default http://127.0.0.1:5000)")
+    parser.add_argument("--requests", type=int, help="Total requests for load_test mode")
+    parser.add_argument("--concurrency", type=int, help="Max requests in flight for load_test mode")
+    parser.add_argument("--rate", type=float, help="Poisson arrival rate (req/s) for load_test mode; default closed loop")
+    parser.add_argument("--switch-adapter", nargs="+", metavar="PATH:SCALE", help="Switch adapters via /lora-adapters halfway through load_test")
+    parser.add_argument("--stub", action="store_true", help="Run load_test against an in-process stub server")
+    parser.add_argument("--perplexity", action="store_true", help="eval_all: score held-out chunks (loss/perplexity per level) instead of generating")
+    parser.add_argument("--holdout-pct", type=float, help="build_dataset/train_all: percent of chunks held out for eval_all --perplexity")
+    parser.add_argument("--draft-model", help="test_gguf/switch_adapter: small draft GGUF for speculative decoding (compared with plain decoding)")
+    parser.add_argument("--repl", action="store_true", help="switch_adapter: interactive prompt session with the model kept loaded")
+    parser.add_argument("--auto", action="store_true", help="test_gguf/switch_adapter: run only the adapter(s) the BM25 router picks for --prompt")
+    parser.add_argument("--top-k", type=int, default=1, help="Adapters blended by --auto")
+    parser.add_argument("--seed", type=int, help="Sampling seed for test_gguf mode")
+    parser.add_argument("--cache", action="store_true", help="Reuse stored responses for deterministic test_gguf/eval_all runs (temp 0 or fixed --seed)")
+    parser.add_argument("--isolate", action="store_true", help="Run each stage in its own python3 process (training levels always do)")
+    parser.add_argument("--jobs", type=int, help="Max post-training stages run concurrently in train_all (default: as many as dependencies allow, 1 = sequential)")
+    parser.add_argument("--profile", action="store_true", help="Record wall/CPU time, peak RSS, disk I/O and GPU memory per stage; report under /workspace/profiles")
     
     args = parser.parse_args()
 
@@ -73,35 +215,47 @@ def main():
         print_welcome_message()
         return
 
+    global ISOLATE, PROFILE
+    ISOLATE = args.isolate
+    if args.profile:
+        import atexit
+        from stage_profiler import RunProfile
+        PROFILE = RunProfile(args.mode, sys.argv[1:])
+        # Written on every exit path, so a failed stage still leaves a report
+        atexit.register(PROFILE.finish)
+
     if args.mode == "pdf_pretest":
-        run("python3 /app/scripts/pdf_pretest.py")
+        run("pdf_pretest")
 
     elif args.mode == "build_dataset":
-        run("python3 /app/scripts/build_dataset.py")
+        run("build_dataset", holdout_argv(args))
 
     elif args.mode == "train_level1":
-        run("python3 /app/scripts/train_lora.py --lora_name level1")
+        run("train_lora", ["--lora_name", "level1"])
 
     elif args.mode == "train_level2":
-        run("python3 /app/scripts/train_lora.py --lora_name level2")
+        run("train_lora", ["--lora_name", "level2"])
 
     elif args.mode == "train_level3":
-        run("python3 /app/scripts/train_lora.py --lora_name level3")
+        run("train_lora", ["--lora_name", "level3"])
 
     elif args.mode == "eval_all":
-        run("python3 /app/scripts/eval_layers.py")
+        cmd = ["--cache"] if args.cache else []
+        if args.perplexity:
+            cmd.append("--perplexity")
+        run("eval_layers", cmd)
 
     elif args.mode == "merge_level":
-        run("python3 /app/scripts/merge_lora.py")
+        run("merge_lora", [])
 
     elif args.mode == "archive_pdfs":
-        run("python3 /app/scripts/archive_used_pdfs.py")
+        run("archive_used_pdfs")
 
     elif args.mode == "convert_to_gguf":
-        run("python3 /app/scripts/convert_to_gguf.py")
+        run("convert_to_gguf")
 
     elif args.mode == "test_gguf":
-        cmd = ["python3", "/app/scripts/test_gguf.py", args.model]
+        cmd = [args.model]
         if args.adapter:
             cmd += ["--adapter", args.adapter]
         if args.adapters_dir:
@@ -114,19 +268,35 @@ def main():
             cmd += ["--temp", str(args.temp)]
         if args.ngl is not None:
             cmd += ["--ngl", str(args.ngl)]
-        run(" ".join(shlex.quote(c) for c in cmd))
+        if args.backend:
+            cmd += ["--backend", args.backend]
+        if args.bench:
+            cmd.append("--bench")
+            cmd += bench_argv(args)
+        if args.draft_model:
+            cmd += ["--draft-model", args.draft_model]
+        if args.auto:
+            cmd += ["--auto", "--top-k", str(args.top_k)]
+        if args.seed is not None:
+            cmd += ["--seed", str(args.seed)]
+        if args.cache:
+            cmd.append("--cache")
+        run("test_gguf", cmd)
 
     elif args.mode == "export_adapters":
-        cmd = ["python3", "/app/scripts/export_lora.py", "--base_model", args.base_gguf]
+        cmd = ["--base_model", args.base_gguf]
         if args.adapters_dir:
             cmd += ["--adapters_dir", args.adapters_dir]
-        run(" ".join(shlex.quote(c) for c in cmd))
+        run("export_lora", cmd)
 
     elif args.mode == "verify_adapters":
-        run("python3 /app/scripts/verify_adapters.py")
+        cmd = ["--base-model", args.model]
+        if args.adapters_dir:
+            cmd += ["--adapters-dir", args.adapters_dir]
+        run("verify_adapters", cmd)
 
     elif args.mode == "switch_adapter":
-        cmd = ["python3", "/app/scripts/switch_adapter.py"]
+        cmd = []
         if args.model:
             cmd += ["--model", args.model]
         if args.adapter:
@@ -141,21 +311,63 @@ def main():
             cmd += ["--temp", str(args.temp)]
         if args.ngl is not None:
             cmd += ["--ngl", str(args.ngl)]
-        run(" ".join(shlex.quote(c) for c in cmd))
+        if args.backend:
+            cmd += ["--backend", args.backend]
+        if args.bench:
+            cmd.append("--bench")
+            cmd += bench_argv(args)
+        if args.draft_model:
+            cmd += ["--draft-model", args.draft_model]
+        if args.auto:
+            cmd += ["--auto", "--top-k", str(args.top_k)]
+        if args.repl:
+            cmd.append("--repl")
+        run("switch_adapter", cmd)
+
+    elif args.mode == "catalog":
+        cmd = [args.adapters_dir or "/workspace/output/adapters_gguf/v3"]
+        if args.adapter:
+            cmd.append(args.adapter)
+        run("gguf_catalog", cmd)
+
+    elif args.mode == "blend_adapters":
+        if not args.blend:
+            parser.error("blend_adapters needs --blend PATH:WEIGHT [PATH:WEIGHT ...]")
+        cmd = ["--adapters"] + args.blend + ["--gguf", "--base_model", args.base_gguf]
+        if args.rank is not None:
+            cmd += ["--rank", str(args.rank)]
+        run("blend_lora", cmd)
+
+    elif args.mode == "load_test":
+        cmd = []
+        if args.url:
+            cmd += ["--url", args.url]
+        if args.requests is not None:
+            cmd += ["--requests", str(args.requests)]
+        if args.concurrency is not None:
+            cmd += ["--concurrency", str(args.concurrency)]
+        if args.rate is not None:
+            cmd += ["--rate", str(args.rate)]
+        if args.max_tokens is not None:
+            cmd += ["--max-tokens", str(args.max_tokens)]
+        if args.temp is not None:
+            cmd += ["--temp", str(args.temp)]
+        if args.switch_adapter:
+            cmd += ["--switch-adapter"] + args.switch_adapter
+        if args.stub:
+            cmd.append("--stub")
+        run("load_test", cmd)
 
     # 🚀 Full pipeline (new PDFs → dataset → LoRA → merge → GGUF → archive PDFs)
     elif args.mode == "train_all":
-        run("python3 /app/scripts/pdf_pretest.py")
-        run("python3 /app/scripts/build_dataset.py")
-        run("python3 /app/scripts/train_lora.py --lora_name level1")
-        run("python3 /app/scripts/train_lora.py --lora_name level2")
-        run("python3 /app/scripts/train_lora.py --lora_name level3")
-        run("python3 /app/scripts/merge_lora.py")
-        run("python3 /app/scripts/convert_to_gguf.py")
-        run("python3 /app/scripts/archive_used_pdfs.py")
+        build_training_dataset(args)
+        run("train_lora", ["--lora_name", "level1"])
+        run("train_lora", ["--lora_name", "level2"])
+        run("train_lora", ["--lora_name", "level3"])
+        run_post_training(args)
 
         print("\n================ DONE ================")
-        print("Model updated & PDFs archived.")
+        print("Model updated, level adapters exported & PDFs archived.")
         print("========================================")
 
 if __name__ == "__main__":
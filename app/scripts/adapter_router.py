@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Lexical adapter router: pick the domain adapter(s) for a prompt with BM25.
+
+Each adapter's training material is chunked the same way build_dataset.py
+chunks documents and put in one inverted index. A prompt is scored against
+every chunk; an adapter's score is the sum of its best chunk scores, and
+the top-k adapters are returned with weights proportional to their scores.
+
+Adapters trained here have a provenance.json in their PEFT folder (written
+by train_lora.py) listing the source documents build_dataset consumed; those
+are read from the content-addressed archive (or raw_pdfs before archiving),
+falling back to the recorded train.jsonl while it is unchanged. Adapters
+trained elsewhere get a hand-filled corpus under CORPORA_DIR/<adapter name>/
+(the name is the GGUF file stem, e.g. ASC_Financial_Accounting), and NAME=PATH
+overrides either. The index is kept as JSON and rebuilt only when a source
+file changes.
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+
+import archive_manifest
+from build_dataset import RAW_DIR, chunk_text
+from gguf_catalog import file_sha256
+
+CORPORA_DIR = os.environ.get("ADAPTER_CORPORA_DIR", "/workspace/data/adapter_corpora")
+INDEX_PATH = os.environ.get("ADAPTER_ROUTER_INDEX", "/workspace/output/adapter_router_index.json")
+CORPUS_EXTENSIONS = (".jsonl", ".txt", ".pdf")
+PEFT_DIRS = ["/workspace/peft", "/workspace/output/peft"]
+PROVENANCE_NAME = "provenance.json"
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+# Chunk scores summed per adapter, so one lucky chunk does not dominate
+TOP_CHUNKS = 3
+# Adapters scoring below this fraction of the best one are not blended in
+MIN_RELATIVE_SCORE = 0.25
+
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have how in is it its of on or that the this to
+was were what when which who why will with what's does do can should would your you i we
+""".split())
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return [t for t in _TOKEN_RE.findall(text.lower())
+            if t not in STOPWORDS and (len(t) > 1 or t.isdigit())]
+
+
+def parse_corpus_specs(specs):
+    """['NAME=PATH', ...] -> {name: path}."""
+    out = {}
+    for spec in specs or []:
+        name, sep, path = spec.partition("=")
+        if not sep or not name or not path:
+            raise ValueError(f"Corpus must be NAME=PATH, got {spec!r}")
+        out[name] = path
+    return out
+
+
+def discover_corpora(corpora_dir=CORPORA_DIR):
+    """One corpus per sub-folder (or top-level file) of corpora_dir, named after it."""
+    if not os.path.isdir(corpora_dir):
+        return {}
+    out = {}
+    for name in sorted(os.listdir(corpora_dir)):
+        path = os.path.join(corpora_dir, name)
+        stem, ext = os.path.splitext(name)
+        if os.path.isdir(path):
+            out[name] = path
+        elif ext.lower() in CORPUS_EXTENSIONS:
+            out[stem] = path
+    return out
+
+
+def provenance_sources(provenance, archived):
+    """Files an adapter was trained from: its source documents, else the unchanged dataset."""
+    files = []
+    for doc in provenance.get("documents", []):
+        entry = archived.get(doc["sha256"])
+        raw = os.path.join(RAW_DIR, doc["file"])
+        if entry:
+            files.append(os.path.join(archive_manifest.ARCHIVE_DIR, entry["path"]))
+        elif os.path.exists(raw):
+            files.append(raw)
+    dataset = provenance.get("dataset") or {}
+    if not files and dataset.get("path") and os.path.exists(dataset["path"]) \
+            and file_sha256(dataset["path"]) == dataset.get("sha256"):
+        files.append(dataset["path"])
+    return files
+
+
+def discover_trained(peft_dirs=PEFT_DIRS):
+    """{adapter name: [source files]} from the provenance.json of adapters trained here."""
+    archived = archive_manifest.load_manifest()["objects"]
+    out, seen = {}, set()
+    for peft_dir in peft_dirs:
+        for path in sorted(glob.glob(os.path.join(peft_dir, "*", PROVENANCE_NAME))):
+            # /workspace/peft is usually a symlink to /workspace/output/peft
+            if os.path.realpath(path) in seen:
+                continue
+            seen.add(os.path.realpath(path))
+            try:
+                with open(path) as f:
+                    files = provenance_sources(json.load(f), archived)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring {path}: {e}")
+                continue
+            if files:
+                out[os.path.basename(os.path.dirname(path))] = files
+    return out
+
+
+def default_corpora(corpora_dir=CORPORA_DIR, peft_dirs=PEFT_DIRS):
+    """Training provenance first; the hand-filled corpora folder covers adapters trained elsewhere."""
+    corpora = discover_corpora(corpora_dir)
+    corpora.update(discover_trained(peft_dirs))
+    return corpora
+
+
+def corpus_files(path):
+    """Files of one corpus: a recorded list, a single file, or every corpus file under a folder."""
+    if isinstance(path, list):
+        return list(path)
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        files += [os.path.join(root, n) for n in sorted(names) if n.lower().endswith(CORPUS_EXTENSIONS)]
+    return files
+
+
+def read_chunks(path):
+    """Text chunks of one corpus file."""
+    lower = path.lower()
+    if lower.endswith(".jsonl"):
+        chunks = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    rec = json.loads(line)
+                    text = rec.get("text") or " ".join(str(rec.get(k, "")) for k in ("instruction", "input", "output"))
+                    chunks += chunk_text(text)
+        return chunks
+    if lower.endswith(".pdf"):
+        from pypdf import PdfReader
+        text = "\n".join(p.extract_text() or "" for p in PdfReader(path).pages)
+    else:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            text = f.read()
+    return chunk_text(text)
+
+
+def fingerprint(corpora):
+    return sorted(
+        [name, p, os.stat(p).st_size, os.stat(p).st_mtime_ns]
+        for name, path in corpora.items() for p in corpus_files(path)
+    )
+
+
+def build_index(corpora):
+    """Inverted BM25 index over the chunks of every corpus."""
+    adapters = sorted(corpora)
+    postings = defaultdict(list)
+    doc_adapter, doc_len = [], []
+    for a, name in enumerate(adapters):
+        n_chunks = 0
+        for path in corpus_files(corpora[name]):
+            for chunk in read_chunks(path):
+                tf = Counter(tokenize(chunk))
+                if not tf:
+                    continue
+                doc = len(doc_len)
+                for term, count in tf.items():
+                    postings[term].append([doc, count])
+                doc_adapter.append(a)
+                doc_len.append(sum(tf.values()))
+                n_chunks += 1
+        print(f"  {name}: {n_chunks} chunks")
+    return {
+        "adapters": adapters,
+        "fingerprint": fingerprint(corpora),
+        "doc_adapter": doc_adapter,
+        "doc_len": doc_len,
+        "avgdl": sum(doc_len) / max(1, len(doc_len)),
+        "postings": postings,
+    }
+
+
+def load_index(corpora=None, index_path=INDEX_PATH, rebuild=False, corpora_dir=CORPORA_DIR):
+    """Load the index, rebuilding it when the corpora changed since it was written."""
+    if corpora is None:
+        corpora = default_corpora(corpora_dir)
+    if not rebuild:
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            if index.get("fingerprint") == fingerprint(corpora):
+                return index
+        except (OSError, ValueError):
+            pass
+    if not corpora:
+        raise RuntimeError(f"No adapter corpora found (no {PROVENANCE_NAME} under {', '.join(PEFT_DIRS)}, "
+                           f"nothing in {corpora_dir}; pass NAME=PATH to add some)")
+
+    print(f"Building adapter router index over {len(corpora)} corpora...")
+    start = time.perf_counter()
+    index = build_index(corpora)
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    tmp = f"{index_path}.tmp.{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path)
+    print(f"Indexed {len(index['doc_len'])} chunks, {len(index['postings'])} terms "
+          f"in {time.perf_counter() - start:.1f}s -> {index_path}")
+    return index
+
+
+def score(index, prompt, allowed=None):
+    """{adapter: score} for a prompt; allowed limits the candidates to those names."""
+    n = len(index["doc_len"])
+    avgdl = index["avgdl"] or 1.0
+    doc_len, doc_adapter = index["doc_len"], index["doc_adapter"]
+    chunk_scores = defaultdict(float)
+    for term, qtf in Counter(tokenize(prompt)).items():
+        plist = index["postings"].get(term)
+        if not plist:
+            continue
+        idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+        for doc, tf in plist:
+            norm = tf * (K1 + 1) / (tf + K1 * (1 - B + B * doc_len[doc] / avgdl))
+            chunk_scores[doc] += qtf * idf * norm
+
+    per_adapter = defaultdict(list)
+    for doc, s in chunk_scores.items():
+        per_adapter[index["adapters"][doc_adapter[doc]]].append(s)
+    return {
+        name: sum(sorted(scores, reverse=True)[:TOP_CHUNKS])
+        for name, scores in per_adapter.items()
+        if allowed is None or name in allowed
+    }
+
+
+def route(index, prompt, top_k=1, allowed=None):
+    """Top-k [(adapter, weight), ...] with weights summing to 1; [] when nothing matches."""
+    scores = score(index, prompt, allowed)
+    ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+    if not ranked or ranked[0][1] <= 0:
+        return []
+    best = ranked[0][1]
+    chosen = [(name, s) for name, s in ranked[:top_k] if s >= MIN_RELATIVE_SCORE * best]
+    total = sum(s for _, s in chosen)
+    return [(name, s / total) for name, s in chosen]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Route a prompt to the best-matching domain adapter(s) with BM25.")
+    parser.add_argument("prompt", nargs="?", help="Prompt to route (omit with --rebuild to only build the index)")
+    parser.add_argument("--top-k", type=int, default=1, help="Number of adapters to select")
+    parser.add_argument("--corpus", nargs="*", metavar="NAME=PATH",
+                        help=f"Extra adapter corpora (added to training provenance and {CORPORA_DIR})")
+    parser.add_argument("--corpora-dir", default=CORPORA_DIR, help="Folder with one corpus per adapter name")
+    parser.add_argument("--index", default=INDEX_PATH, help="Path of the persistent index")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the index even if the corpora are unchanged")
+    args = parser.parse_args(argv)
+
+    corpora = default_corpora(args.corpora_dir)
+    corpora.update(parse_corpus_specs(args.corpus))
+    try:
+        index = load_index(corpora, args.index, rebuild=args.rebuild, corpora_dir=args.corpora_dir)
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        return 1
+    if not args.prompt:
+        return 0
+
+    start = time.perf_counter()
+    scores = score(index, args.prompt)
+    routed = route(index, args.prompt, args.top_k)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    print(f"Routed in {elapsed:.1f} ms:")
+    for name, weight in routed:
+        print(f"  {name:40s} weight {weight:.2f}  (score {scores[name]:.2f})")
+    if not routed:
+        print("  no adapter matched; use the base model")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
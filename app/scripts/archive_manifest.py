@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Content-addressed archive of trained documents.
+
+Archived files are stored once per content hash under
+PDF_ARCHIVE_PATH/objects/<sha[:2]>/<sha><ext>. manifest.json maps each
+sha256 to its object and every file name it was uploaded under. That lets
+pdf_pretest and build_dataset skip a re-uploaded document, even a renamed
+one, before parsing it.
+
+build_dataset records the documents it actually consumed in CONSUMED_PATH,
+with a fingerprint of raw_pdfs at build time. archive_used_pdfs archives
+only those, and train_all skips rebuilding a dataset whose fingerprint
+still matches. Files archived by name before the
+manifest existed (loose files in the archive folder) are hashed and
+adopted into the manifest the first time it is loaded. An unreadable
+manifest is moved aside and rebuilt from the hash-named objects.
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import time
+
+from gguf_catalog import file_sha256
+
+ARCHIVE_DIR = os.environ.get("PDF_ARCHIVE_PATH", "/workspace/data/archive")
+MANIFEST_NAME = "manifest.json"
+CONSUMED_PATH = "/workspace/data/processed/consumed_documents.json"
+DOC_EXTENSIONS = (".pdf", ".txt")
+
+
+def _now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+def object_path(sha, ext):
+    """Archive-relative path of the object holding content `sha`."""
+    return os.path.join("objects", sha[:2], sha + ext.lower())
+
+
+def _rebuild_objects(archive_dir):
+    """Manifest entries recovered from the object store alone (original names and dates are lost)."""
+    objects = {}
+    for full in sorted(glob.glob(os.path.join(archive_dir, "objects", "*", "*"))):
+        sha, ext = os.path.splitext(os.path.basename(full))
+        objects[sha] = {"path": os.path.relpath(full, archive_dir), "size": os.path.getsize(full),
+                        "names": [sha[:12] + ext], "archived": _now()}
+    return objects
+
+
+def load_manifest(archive_dir=ARCHIVE_DIR):
+    """{"objects": {sha256: {"path", "size", "names", "archived"}}}, adopting loose legacy files."""
+    path = os.path.join(archive_dir, MANIFEST_NAME)
+    changed = False
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {"objects": {}}
+    except ValueError as e:
+        corrupt = f"{path}.corrupt-{time.strftime('%Y%m%d-%H%M%S')}"
+        os.replace(path, corrupt)
+        print(f"Warning: {path} is unreadable ({e}); moved it to {corrupt} "
+              f"and rebuilt the manifest from {os.path.join(archive_dir, 'objects')}")
+        manifest = {"objects": _rebuild_objects(archive_dir)}
+        changed = True
+
+    # Loose files already listed (as an object or an extra name) are not hashed again
+    known = set()
+    for entry in manifest["objects"].values():
+        known.add(entry["path"])
+        known.update(entry["names"])
+    adopted = 0
+    if os.path.isdir(archive_dir):
+        for name in sorted(os.listdir(archive_dir)):
+            full = os.path.join(archive_dir, name)
+            if name in known or not name.lower().endswith(DOC_EXTENSIONS) or not os.path.isfile(full):
+                continue
+            sha = file_sha256(full)
+            entry = manifest["objects"].get(sha)
+            if entry is None:
+                manifest["objects"][sha] = {
+                    "path": name, "size": os.path.getsize(full), "names": [name], "archived": _now(),
+                }
+                adopted += 1
+            else:
+                # Same content archived under another name: only the name is new
+                entry["names"].append(name)
+            changed = True
+    if adopted:
+        print(f"Adopted {adopted} previously archived file(s) into {path}")
+    if changed:
+        save_manifest(manifest, archive_dir)
+    return manifest
+
+
+def save_manifest(manifest, archive_dir=ARCHIVE_DIR):
+    _write_json(os.path.join(archive_dir, MANIFEST_NAME), manifest)
+
+
+def scan(raw_dir, manifest, extensions=DOC_EXTENSIONS):
+    """
+    Hash the documents in raw_dir and split them into new and duplicate ones.
+
+    Returns ([(name, sha), ...], [(name, sha, original_name), ...]). A file is
+    a duplicate when its content is already archived, or when an earlier
+    file in the same folder has the same content.
+    """
+    fresh, duplicates, seen = [], [], {}
+    for name in sorted(os.listdir(raw_dir)):
+        if not name.lower().endswith(extensions):
+            continue
+        sha = file_sha256(os.path.join(raw_dir, name))
+        archived = manifest["objects"].get(sha)
+        if archived:
+            duplicates.append((name, sha, archived["names"][0]))
+        elif sha in seen:
+            duplicates.append((name, sha, seen[sha]))
+        else:
+            seen[sha] = name
+            fresh.append((name, sha))
+    return fresh, duplicates
+
+
+def raw_fingerprint(raw_dir, extensions=DOC_EXTENSIONS):
+    """[[name, size, mtime_ns], ...] of the documents in raw_dir; changes when an upload is added, removed or replaced."""
+    out = []
+    if os.path.isdir(raw_dir):
+        for name in sorted(os.listdir(raw_dir)):
+            if name.lower().endswith(extensions):
+                st = os.stat(os.path.join(raw_dir, name))
+                out.append([name, st.st_size, st.st_mtime_ns])
+    return out
+
+
+def record_consumed(files, dataset, path=CONSUMED_PATH, **build):
+    """Record the [{"file", "sha256", "size"}, ...] a dataset build was made from, plus build settings."""
+    _write_json(path, {"built": _now(), "dataset": dataset, "files": files, **build})
+
+
+def dataset_is_current(raw_dir, holdout_pct, path=CONSUMED_PATH):
+    """True when the last dataset build used exactly the documents now in raw_dir and the same hold-out."""
+    try:
+        build = load_build(path)
+    except (OSError, ValueError):
+        return False
+    return (bool(build.get("files")) and os.path.exists(build.get("dataset", ""))
+            and build.get("holdout_pct") == holdout_pct and build.get("raw") == raw_fingerprint(raw_dir))
+
+
+def load_build(path=CONSUMED_PATH):
+    """The record written by record_consumed(), or {} before the first build."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def load_consumed(path=CONSUMED_PATH):
+    return load_build(path).get("files", [])
+
+
+def mark_trained(path=CONSUMED_PATH):
+    """Note that an adapter was trained on the last build, so its documents may be archived."""
+    build = load_build(path)
+    if build:
+        build["trained"] = _now()
+        _write_json(path, build)
+
+
+def archive_file(manifest, src, sha, name, archive_dir=ARCHIVE_DIR):
+    """Move src into the archive under its content hash; returns False if the content was already there."""
+    entry = manifest["objects"].get(sha)
+    if entry is None:
+        rel = object_path(sha, os.path.splitext(name)[1])
+        dst = os.path.join(archive_dir, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.move(src, dst)
+        manifest["objects"][sha] = {"path": rel, "size": os.path.getsize(dst), "names": [name], "archived": _now()}
+        return True
+    os.remove(src)
+    if name not in entry["names"]:
+        entry["names"].append(name)
+    return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Look up documents in the content-addressed archive.")
+    parser.add_argument("files", nargs="*", help="Files to check against the manifest (default: list the archive)")
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR, help="Archive folder holding manifest.json")
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest(args.archive_dir)
+    if not args.files:
+        objects = manifest["objects"]
+        total = sum(e["size"] for e in objects.values())
+        print(f"{args.archive_dir}: {len(objects)} documents, {total / 1e6:.1f} MB")
+        for sha, entry in sorted(objects.items(), key=lambda kv: kv[1]["archived"]):
+            print(f"  {sha[:12]}  {entry['archived']}  {', '.join(entry['names'])}")
+        return 0
+    for path in args.files:
+        entry = manifest["objects"].get(file_sha256(path))
+        if entry:
+            print(f"{path}: already archived as {', '.join(entry['names'])} ({entry['archived']})")
+        else:
+            print(f"{path}: new")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,58 @@
 import os
-import shutil
 
-RAW_DIR = "/workspace/data/raw_pdfs"
+import archive_manifest
+from archive_manifest import ARCHIVE_DIR
+from gguf_catalog import file_sha256
 
-# Allows user to change archive target without modifying code
-ARCHIVE_DIR = os.environ.get(
-    "PDF_ARCHIVE_PATH",
-    "/workspace/data/archive"
-)
+RAW_DIR = "/workspace/data/raw_pdfs"
 
 def main():
-    os.makedirs(ARCHIVE_DIR, exist_ok=True)
-
-    files = os.listdir(RAW_DIR)
-    if not files:
-        print("No PDFs found in raw_pdfs. Nothing to archive.")
+    # Only what the last build_dataset run trained on; later uploads stay in raw_pdfs
+    build = archive_manifest.load_build()
+    consumed = build.get("files")
+    if not consumed:
+        print("No documents recorded by the last dataset build. Nothing to archive.")
         return
+    if build.get("trained") is False:
+        # e.g. the dataset train_all prebuilt for its next run
+        print("The last dataset build has not been trained on yet. Nothing to archive.")
+        return
+
+    manifest = archive_manifest.load_manifest()
+    stored = known = removed = 0
+    for doc in consumed:
+        f = doc["file"]
+        src = os.path.join(RAW_DIR, f)
+        if not os.path.exists(src):
+            if doc["sha256"] not in manifest["objects"]:
+                print(f"Missing: {f} (consumed by the dataset build but no longer in raw_pdfs)")
+            continue
+        sha = file_sha256(src)
+        if sha != doc["sha256"]:
+            print(f"Skipped: {f} changed since the dataset build, left in raw_pdfs")
+            continue
+        if archive_manifest.archive_file(manifest, src, sha, f):
+            stored += 1
+            print(f"Archived: {f} ({sha[:12]})")
+        else:
+            known += 1
+            print(f"Archived: {f} (content already stored)")
 
-    for f in files:
-        if f.lower().endswith(".pdf") or f.lower().endswith(".txt"):
-            src = os.path.join(RAW_DIR, f)
-            dst = os.path.join(ARCHIVE_DIR, f)
-            shutil.move(src, dst)
-            print(f"Archived: {f}")
+    # Re-uploads skipped as duplicates are never consumed; drop them so they are not re-hashed every run
+    if os.path.isdir(RAW_DIR):
+        _, duplicates = archive_manifest.scan(RAW_DIR, manifest)
+        for f, sha, original in duplicates:
+            if sha in manifest["objects"]:
+                archive_manifest.archive_file(manifest, os.path.join(RAW_DIR, f), sha, f)
+                removed += 1
+                print(f"Removed re-upload: {f} (same content as {original})")
+    archive_manifest.save_manifest(manifest)
 
     print("===================================================")
-    print("All used PDF/TXT files were moved to:")
+    print(f"{stored} new and {known} already stored document(s) archived to:")
     print(ARCHIVE_DIR)
+    if removed:
+        print(f"{removed} re-uploaded duplicate(s) removed from raw_pdfs")
     print("===================================================")
 
 if __name__ == "__main__":
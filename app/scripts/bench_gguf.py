@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Latency/throughput benchmark for GGUF models and adapters.
+
+Runs a fixed prompt suite through llama-cli over a grid of (model, adapter,
+threads, ngl, context size), repeating every run, and records prompt-eval
+and generation tokens/sec (from llama.cpp's timing output), time to first
+token and peak RSS of the llama-cli process. Time to first token is prompt
+evaluation plus one decode step, both from llama.cpp's timings, so model
+load is not included. Results are written as CSV
+(one row per grid point, medians and p95) and JSON (summary plus raw runs).
+Defaults are CPU-only (ngl 0).
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import test_gguf
+from script_helpers import BENCH_PROMPTS, DEFAULT_OUT_DIR, percentile
+
+# llama_perf_context_print / llama_print_timings lines, e.g.
+#   ...: prompt eval time =  123.45 ms /    10 tokens (   12.35 ms per token,    81.00 tokens per second)
+_TIMING_RE = re.compile(
+    r":\s+(load|prompt eval|eval) time\s*=\s*([\d.]+) ms"
+    r"(?:\s*/\s*(\d+) (?:tokens|runs)\s*\(\s*[\d.]+ ms per token,\s*([\d.]+) tokens per second\))?"
+)
+
+METRICS = ["prompt_tps", "eval_tps", "ttft_ms", "load_ms", "peak_rss_mb"]
+
+
+def parse_timings(text):
+    """Extract load/prompt-eval/eval timings from llama.cpp stderr."""
+    out = {}
+    keys = {"load": "load", "prompt eval": "prompt", "eval": "eval"}
+    for kind, ms, count, tps in _TIMING_RE.findall(text):
+        key = keys[kind]
+        out[f"{key}_ms"] = float(ms)
+        if count:
+            out[f"{key}_tokens"] = int(count)
+        if tps:
+            out[f"{key}_tps"] = float(tps)
+    return out
+
+
+def parse_list(value, cast=int):
+    return [cast(v) for v in str(value).split(",") if v.strip()]
+
+
+def time_to_first_token(timings):
+    """Prompt-eval time plus one decode step (ms), or None without timings."""
+    if "prompt_ms" not in timings:
+        return None
+    step = timings["eval_ms"] / timings["eval_tokens"] if timings.get("eval_tokens") else 0.0
+    return timings["prompt_ms"] + step
+
+
+def run_once(binary, model, adapter, prompt, threads, ngl, ctx, max_tokens):
+    """One llama-cli run; returns timings, TTFT and peak RSS."""
+    cmd = [
+        binary, "-m", model, "-p", prompt, "-n", str(max_tokens),
+        "-t", str(threads), "-c", str(ctx), "-ngl", str(ngl),
+        "--temp", "0", "--seed", "42", "--no-display-prompt",
+    ]
+    if adapter:
+        cmd += ["--lora", adapter]
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # stderr carries the timings; drain it on a thread so neither pipe can fill up
+    stderr_chunks = []
+    reader = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True)
+    reader.start()
+
+    first_output = None
+    output = []
+    while True:
+        chunk = os.read(proc.stdout.fileno(), 4096)
+        if not chunk:
+            break
+        if first_output is None and chunk.strip():
+            first_output = time.perf_counter()
+        output.append(chunk)
+    reader.join()
+    proc.stdout.close()
+    proc.stderr.close()
+
+    # wait4 gives the child's own rusage, including its peak RSS
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    end = time.perf_counter()
+
+    text = b"".join(output).decode(errors="replace")
+    result = parse_timings(b"".join(stderr_chunks).decode(errors="replace"))
+    result.update(
+        ok=proc.returncode == 0 and bool(text.strip()),
+        returncode=proc.returncode,
+        wall_ms=(end - start) * 1000,
+        # Launch to first printed text, model load included; kept in the raw runs only
+        first_output_ms=None if first_output is None else (first_output - start) * 1000,
+        ttft_ms=time_to_first_token(result),
+        peak_rss_mb=usage.ru_maxrss / 1024,
+    )
+    return result
+
+
+def summarize(runs):
+    row = {"runs": len(runs), "failures": sum(not r["ok"] for r in runs)}
+    for metric in METRICS:
+        values = [r[metric] for r in runs if r["ok"] and r.get(metric) is not None]
+        row[f"{metric}_median"] = round(statistics.median(values), 2) if values else None
+        row[f"{metric}_p95"] = round(percentile(values, 95), 2) if values else None
+    return row
+
+
+def run_grid(models, adapters, threads, ngls, ctxs, repeats=3, max_tokens=64,
+             prompts=BENCH_PROMPTS, out_dir=DEFAULT_OUT_DIR, binary=None):
+    """Benchmark every grid point; adapters may contain None for the base model."""
+    for name, values in (("models", models), ("adapters", adapters), ("threads", threads),
+                         ("ngl", ngls), ("ctx", ctxs), ("prompts", prompts)):
+        if not values:
+            raise ValueError(f"Empty {name} list: nothing to benchmark")
+    if repeats < 1:
+        raise ValueError("--repeats must be at least 1")
+    binary = binary or test_gguf.find_binary()
+    if not binary:
+        raise RuntimeError("llama-cli or main binary not found in /workspace/llama.cpp/build/bin/")
+
+    grid = list(itertools.product(models, adapters, threads, ngls, ctxs))
+    print(f"Benchmarking {len(grid)} configuration(s) x {len(prompts)} prompt(s) x {repeats} repeat(s)")
+
+    summary, raw = [], []
+    for model, adapter, t, ngl, ctx in grid:
+        config = {
+            "model": os.path.basename(model),
+            "adapter": os.path.basename(adapter) if adapter else "(base)",
+            "threads": t, "ngl": ngl, "ctx": ctx,
+        }
+        print(f"\n>>> {config}")
+        runs = []
+        for rep in range(repeats):
+            for i, prompt in enumerate(prompts):
+                r = run_once(binary, model, adapter, prompt, t, ngl, ctx, max_tokens)
+                r.update(config, repeat=rep, prompt_index=i)
+                runs.append(r)
+                status = "ok" if r["ok"] else f"FAILED (rc={r['returncode']})"
+                print(f"  rep {rep} prompt {i}: gen {r.get('eval_tps', 0):.1f} tok/s, "
+                      f"ttft {r['ttft_ms'] or 0:.0f} ms, rss {r['peak_rss_mb']:.0f} MB {status}")
+        raw += runs
+        summary.append({**config, **summarize(runs)})
+
+    os.makedirs(out_dir, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    csv_path = os.path.join(out_dir, f"bench_{stamp}.csv")
+    json_path = os.path.join(out_dir, f"bench_{stamp}.json")
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(summary[0].keys()))
+        writer.writeheader()
+        writer.writerows(summary)
+    with open(json_path, "w") as f:
+        json.dump({"prompts": prompts, "repeats": repeats, "max_tokens": max_tokens,
+                   "summary": summary, "runs": raw}, f, indent=2)
+
+    print_summary(summary)
+    print(f"\nWrote {csv_path}\nWrote {json_path}")
+    return summary
+
+
+def print_summary(summary):
+    print("\n" + "=" * 100)
+    print("BENCHMARK SUMMARY (median / p95)")
+    print("=" * 100)
+    print(f"  {'model':28s} {'adapter':24s} {'t':>3s} {'ngl':>3s} {'ctx':>5s} "
+          f"{'pp tok/s':>15s} {'gen tok/s':>13s} {'ttft ms':>15s} {'rss MB':>7s} {'fail':>4s}")
+
+    def pair(row, metric):
+        med, p95 = row[f"{metric}_median"], row[f"{metric}_p95"]
+        return "-" if med is None else f"{med:.1f}/{p95:.1f}"
+
+    for row in summary:
+        rss = row["peak_rss_mb_median"]
+        print(f"  {row['model'][:28]:28s} {row['adapter'][:24]:24s} {row['threads']:3d} {row['ngl']:3d} {row['ctx']:5d} "
+              f"{pair(row, 'prompt_tps'):>15s} {pair(row, 'eval_tps'):>13s} {pair(row, 'ttft_ms'):>15s} "
+              f"{'-' if rss is None else f'{rss:.0f}':>7s} {row['failures']:4d}")
+    print("=" * 100)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark GGUF models/adapters over threads, ngl and context size.")
+    parser.add_argument("--models", nargs="+", required=True, help="Base GGUF model(s)")
+    parser.add_argument("--adapters", nargs="*", default=[], help="GGUF adapter file(s)")
+    parser.add_argument("--adapters-dir", help="Benchmark every adapter in this directory")
+    parser.add_argument("--no-base", action="store_true", help="Skip the no-adapter configuration")
+    parser.add_argument("--threads", default=str(os.cpu_count() or 4), help="Comma-separated thread counts, e.g. 4,8,16")
+    parser.add_argument("--ngl", default="0", help="Comma-separated GPU offload layers (default 0: CPU only)")
+    parser.add_argument("--ctx", default="2048", help="Comma-separated context sizes")
+    parser.add_argument("--repeats", type=int, default=3, help="Repeats of the prompt suite per configuration")
+    parser.add_argument("--max-tokens", type=int, default=64, help="Tokens generated per prompt")
+    parser.add_argument("--out-dir", default=DEFAULT_OUT_DIR, help="Where to write CSV/JSON results")
+    args = parser.parse_args(argv)
+
+    missing = [p for p in args.models + args.adapters if not os.path.isfile(p)]
+    if args.adapters_dir and not os.path.isdir(args.adapters_dir):
+        missing.append(args.adapters_dir)
+    for path in missing:
+        print(f"Error: not found: {path}")
+    if missing:
+        return 1
+
+    adapters = list(args.adapters)
+    if args.adapters_dir:
+        adapters += test_gguf.list_adapters(args.adapters_dir)
+    for model in args.models:
+        bad = test_gguf.incompatible_adapters(model, adapters) if adapters else []
+        adapters = [a for a in adapters if os.path.abspath(a) not in bad]
+    adapters = ([] if args.no_base else [None]) + adapters
+    if not adapters:
+        print("Nothing to benchmark")
+        return 1
+
+    try:
+        summary = run_grid(
+            args.models, adapters, parse_list(args.threads), parse_list(args.ngl), parse_list(args.ctx),
+            repeats=args.repeats, max_tokens=args.max_tokens, out_dir=args.out_dir,
+        )
+    except (RuntimeError, ValueError) as e:
+        print(f"Error: {e}")
+        return 1
+    return 0 if all(row["failures"] == 0 for row in summary) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
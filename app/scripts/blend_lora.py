@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Blend weighted PEFT LoRA adapters offline into one low-rank adapter.
+
+For every target module the weighted deltas sum_i w_i * s_i * B_i @ A_i
+(s_i = lora_alpha / r of adapter i) are combined and re-factorized to the
+target rank with a truncated SVD. The SVD runs on the small stacked factors
+(QR of the concatenated A and B), so the full out x in delta is never
+materialized. The result is saved with lora_alpha == r, i.e. scale 1.0, so
+serving the blend costs the same as serving a single adapter.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+import export_lora
+from script_helpers import parse_weighted
+
+DEFAULT_OUTPUT_DIR = "/workspace/output/peft/blends"
+DEFAULT_GGUF_DIR = "/workspace/output/adapters_gguf/blends"
+
+
+def load_adapter(path):
+    """Return (config, scale, {module: {"A": tensor, "B": tensor}}) for a PEFT adapter folder."""
+    import torch
+
+    with open(os.path.join(path, "adapter_config.json")) as f:
+        config = json.load(f)
+    if config.get("rank_pattern") or config.get("alpha_pattern"):
+        raise ValueError(f"{path}: per-module rank/alpha patterns are not supported")
+
+    safetensors_path = os.path.join(path, "adapter_model.safetensors")
+    if os.path.exists(safetensors_path):
+        from safetensors.torch import load_file
+        state = load_file(safetensors_path)
+    else:
+        state = torch.load(os.path.join(path, "adapter_model.bin"), map_location="cpu")
+
+    r = config["r"]
+    alpha = config["lora_alpha"]
+    scale = alpha / math.sqrt(r) if config.get("use_rslora") else alpha / r
+
+    modules = {}
+    for key, tensor in state.items():
+        for half in ("A", "B"):
+            marker = f".lora_{half}."
+            if marker in key:
+                modules.setdefault(key.split(marker)[0], {})[half] = tensor
+    return config, scale, modules
+
+
+def blend_module(parts, rank):
+    """
+    Re-factorize sum(w * B @ A) over parts [(w, A, B), ...] to the given rank.
+
+    Returns (A [rank, in], B [out, rank], relative Frobenius error). Ranks the
+    combined delta does not have are zero-padded so every module has the
+    same r.
+    """
+    import torch
+
+    b_cat = torch.cat([w * B.float() for w, _, B in parts], dim=1)
+    a_cat = torch.cat([A.float() for _, A, _ in parts], dim=0)
+
+    q_b, r_b = torch.linalg.qr(b_cat)
+    q_a, r_a = torch.linalg.qr(a_cat.T)
+    u, s, vh = torch.linalg.svd(r_b @ r_a.T)
+
+    k = min(rank, s.numel())
+    root = s[:k].sqrt()
+    new_b = (q_b @ u[:, :k]) * root
+    new_a = root[:, None] * (vh[:k] @ q_a.T)
+
+    energy = s.pow(2)
+    total = energy.sum().item()
+    error = math.sqrt(energy[k:].sum().item() / total) if total > 0 else 0.0
+
+    if k < rank:
+        new_a = torch.cat([new_a, new_a.new_zeros(rank - k, new_a.shape[1])], dim=0)
+        new_b = torch.cat([new_b, new_b.new_zeros(new_b.shape[0], rank - k)], dim=1)
+    return new_a, new_b, error
+
+
+def blend(weighted, rank, output_dir):
+    """Blend [(adapter_path, weight), ...] into output_dir and return the per-module report."""
+    from safetensors.torch import save_file
+
+    adapters = []
+    for path, weight in weighted:
+        config, scale, modules = load_adapter(path)
+        print(f"Loaded {path}: r={config['r']}, alpha={config['lora_alpha']}, "
+              f"weight={weight:g}, {len(modules)} modules")
+        adapters.append((path, weight, config, scale, modules))
+
+    dtype = next(iter(adapters[0][4].values()))["A"].dtype
+    module_names = sorted({name for *_, modules in adapters for name in modules})
+
+    state, report = {}, []
+    for name in module_names:
+        parts, sources = [], []
+        for path, weight, config, scale, modules in adapters:
+            if name in modules:
+                parts.append((weight * scale, modules[name]["A"], modules[name]["B"]))
+                sources.append(config["r"])
+        new_a, new_b, error = blend_module(parts, rank)
+        state[f"{name}.lora_A.weight"] = new_a.to(dtype).contiguous()
+        state[f"{name}.lora_B.weight"] = new_b.to(dtype).contiguous()
+        report.append({"module": name, "source_ranks": sources, "combined_rank": sum(sources), "rel_error": error})
+
+    config = dict(adapters[0][2])
+    config.update(
+        r=rank,
+        lora_alpha=rank,
+        use_rslora=False,
+        rank_pattern={},
+        alpha_pattern={},
+        target_modules=sorted({name.rsplit(".", 1)[-1] for name in module_names}),
+    )
+
+    os.makedirs(output_dir, exist_ok=True)
+    save_file(state, os.path.join(output_dir, "adapter_model.safetensors"))
+    with open(os.path.join(output_dir, "adapter_config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+    with open(os.path.join(output_dir, "blend_report.json"), "w") as f:
+        json.dump({
+            "sources": [{"path": path, "weight": weight} for path, weight in weighted],
+            "rank": rank,
+            "modules": report,
+        }, f, indent=2)
+    return report
+
+
+def print_report(report, worst=10):
+    errors = [m["rel_error"] for m in report]
+    print("\n" + "=" * 70)
+    print("BLEND RECONSTRUCTION ERROR (relative Frobenius norm)")
+    print("=" * 70)
+    print(f"Modules: {len(report)}   mean: {sum(errors) / max(1, len(errors)):.4f}   max: {max(errors, default=0):.4f}")
+    print(f"\nWorst {min(worst, len(report))} modules:")
+    for m in sorted(report, key=lambda m: m["rel_error"], reverse=True)[:worst]:
+        print(f"  {m['module']:70s} r={m['combined_rank']:3d} -> {m['rel_error']:.4f}")
+    print("=" * 70)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Blend weighted PEFT adapters into one low-rank adapter.")
+    parser.add_argument("--adapters", nargs="+", required=True, help="Adapter folders as PATH:WEIGHT (e.g. /workspace/output/peft/A:0.6)")
+    parser.add_argument("--rank", type=int, default=16, help="Rank of the blended adapter")
+    parser.add_argument("--name", help="Name of the blend (default: adapter names joined with '+')")
+    parser.add_argument("--output_dir", default=DEFAULT_OUTPUT_DIR, help="Directory to write the blended PEFT adapter folder into")
+    parser.add_argument("--gguf", action="store_true", help="Also export the blend to GGUF")
+    parser.add_argument("--gguf_dir", default=DEFAULT_GGUF_DIR, help="Directory for the GGUF export")
+    parser.add_argument("--base_model", help="Path to base GGUF model (optional, for binary export)")
+    args = parser.parse_args(argv)
+
+    weighted = [parse_weighted(spec) for spec in args.adapters]
+    name = args.name or "+".join(os.path.basename(p.rstrip("/")) for p, _ in weighted)
+    out_dir = os.path.join(args.output_dir, name)
+
+    report = blend(weighted, args.rank, out_dir)
+    print_report(report)
+    print(f"Blended adapter saved to: {out_dir}")
+
+    if args.gguf:
+        gguf_path = os.path.join(args.gguf_dir, f"{name}.gguf")
+        if not export_lora.export_single_adapter(out_dir, gguf_path, args.base_model):
+            return 1
+        print(f"GGUF adapter saved to: {gguf_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,15 @@
+import argparse
+import hashlib
 import json
 import os
-from pypdf import PdfReader
+
+import archive_manifest
+from gguf_catalog import file_sha256
 
 PRETEST = "/workspace/data/processed/pdf_pretest.json"
 RAW_DIR = "/workspace/data/raw_pdfs"
 OUT_JSONL = "/workspace/data/processed/train.jsonl"
+HOLDOUT_JSONL = "/workspace/data/processed/heldout.jsonl"
 
 def chunk_text(text, max_chars=1000):
     paragraphs = [p.strip() for p in text.split("\n") if p.strip()]
@@ -19,7 +24,20 @@ def chunk_text(text, max_chars=1000):
         out.append(cur)
     return out
 
-def main():
+def is_heldout(chunk, pct):
+    """Stable split: a chunk stays on the same side however the dataset grows."""
+    return pct > 0 and int(hashlib.sha1(chunk.encode("utf-8")).hexdigest(), 16) % 10000 < pct * 100
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chunk recommended PDFs into the training JSONL.")
+    parser.add_argument("--holdout-pct", type=float, default=0.0,
+                        help=f"Percent of chunks written to {HOLDOUT_JSONL} instead of the training set (for eval_layers --perplexity)")
+    args = parser.parse_args(argv)
+
+    from pypdf import PdfReader
+
+    # Taken first, so an upload arriving mid-build makes the next train_all rebuild
+    raw = archive_manifest.raw_fingerprint(RAW_DIR)
     with open(PRETEST) as f:
         meta = json.load(f)
 
@@ -27,23 +45,49 @@ def main():
 
     if not good:
         print("No recommended PDFs found. Check the pretest JSON.")
+        archive_manifest.record_consumed([], OUT_JSONL)
         return
 
     os.makedirs(os.path.dirname(OUT_JSONL), exist_ok=True)
 
-    count = 0
-    with open(OUT_JSONL, "w", encoding="utf-8") as out:
+    # Re-checked here: the archive may have changed since pdf_pretest ran
+    archived = archive_manifest.load_manifest()["objects"]
+    consumed, seen = [], set()
+    count = heldout = 0
+    with open(OUT_JSONL, "w", encoding="utf-8") as out, \
+            open(HOLDOUT_JSONL if args.holdout_pct > 0 else os.devnull, "w", encoding="utf-8") as held:
         for fname in good:
             path = os.path.join(RAW_DIR, fname)
+            if not os.path.exists(path):
+                print(f"Skipping {fname}: no longer in {RAW_DIR}")
+                continue
+            sha = file_sha256(path)
+            if sha in archived or sha in seen:
+                print(f"Skipping {fname}: duplicate of an already trained document")
+                continue
+            seen.add(sha)
+            consumed.append({"file": fname, "sha256": sha, "size": os.path.getsize(path)})
             reader = PdfReader(path)
             text = "\n".join(
                 [p.extract_text() or "" for p in reader.pages]
             )
             for chunk in chunk_text(text):
-                out.write(json.dumps({"text": chunk}, ensure_ascii=False) + "\n")
-                count += 1
+                record = json.dumps({"text": chunk}, ensure_ascii=False) + "\n"
+                if is_heldout(chunk, args.holdout_pct):
+                    held.write(record)
+                    heldout += 1
+                else:
+                    out.write(record)
+                    count += 1
 
-    print(f"Dataset ready: {OUT_JSONL} ({count} chunks)")
+    archive_manifest.record_consumed(consumed, OUT_JSONL, raw=raw, holdout_pct=args.holdout_pct, trained=False)
+    print(f"Dataset ready: {OUT_JSONL} ({count} chunks from {len(consumed)} documents)")
+    if args.holdout_pct > 0:
+        print(f"Held out: {HOLDOUT_JSONL} ({heldout} chunks)")
+    elif os.path.exists(HOLDOUT_JSONL):
+        # A held-out set from an earlier build could overlap what is trained now
+        os.remove(HOLDOUT_JSONL)
+        print(f"Removed stale {HOLDOUT_JSONL} (no --holdout-pct this build)")
 
 if __name__ == "__main__":
     main()
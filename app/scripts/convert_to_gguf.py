@@ -32,8 +32,9 @@ def main():
     # Convert HF model → GGUF FP16 (underscore filename, no --model-dir flag)
     run(f"python3 {LLAMA_CPP}/convert_hf_to_gguf.py {HF_MERGED} --outfile {f16_path}")
 
-    # Quantize to Q4_K_M
-    run(f"{QUANT_BIN} {f16_path} {target_path} Q4_K_M")
+    # Quantize to Q4_K_M (nthreads follows the scheduler's per-stage thread cap when set)
+    nthreads = os.environ.get("OMP_NUM_THREADS", "")
+    run(f"{QUANT_BIN} {f16_path} {target_path} Q4_K_M {nthreads}".rstrip())
 
     print("GGUF created:", target_path)
 
@@ -1,43 +1,339 @@
-import json, os
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
-import torch
+import argparse, json, math, os, time
+from contextlib import contextmanager
 
 HF="/workspace/models/hf_mistral"
+HELDOUT="/workspace/data/processed/heldout.jsonl"
+PERPLEXITY_OUT="/workspace/eval/perplexity.json"
 PROMPTS=[
     "Summarize a quarterly financial report.",
     "Explain net interest income vs non-interest income.",
     "Estimate liquidity risk from a balance sheet."
 ]
+# Shared prefixes shorter than this (e.g. just BOS) are not worth a separate cache
+MIN_PREFIX_TOKENS=8
+SCENARIOS={
+    "base":[],
+    "level1":["/workspace/peft/level1"],
+    "level2":["/workspace/peft/level2"],
+    "level3":["/workspace/peft/level3"],
+}
 
-def run_scenario(name, adapters):
-    tokenizer=AutoTokenizer.from_pretrained(HF)
-    m=AutoModelForCausalLM.from_pretrained(HF,device_map="auto")
+def load_model(adapter_paths, base=HF, device="auto"):
+    """Load the tokenizer and base model once and register every adapter under its folder name."""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from peft import PeftModel
 
-    for ad in adapters:
-        m=PeftModel.from_pretrained(m,ad)
+    tokenizer=AutoTokenizer.from_pretrained(base)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token=tokenizer.eos_token
+    tokenizer.padding_side="left"
+    m=AutoModelForCausalLM.from_pretrained(base,device_map=device)
 
-    results=[]
-    for p in PROMPTS:
-        out=m.generate(**tokenizer(p,return_tensors="pt").to(m.device),
-                       max_new_tokens=256)
-        txt=tokenizer.decode(out[0],skip_special_tokens=True)
-        results.append({"scenario":name,"prompt":p,"response":txt})
+    names={}
+    for path in adapter_paths:
+        name=os.path.basename(path.rstrip("/"))
+        if isinstance(m,PeftModel):
+            m.load_adapter(path,adapter_name=name)
+        else:
+            m=PeftModel.from_pretrained(m,path,adapter_name=name)
+        names[path]=name
+    m.eval()
+    return tokenizer,m,names
+
+@contextmanager
+def scenario(m, adapter_names):
+    """Activate adapters for one scenario: none disables them, several are stacked."""
+    if not adapter_names:
+        if hasattr(m,"disable_adapter"):
+            with m.disable_adapter():
+                yield
+        else:
+            yield
+        return
+
+    if len(adapter_names)==1:
+        m.set_adapter(adapter_names[0])
+    else:
+        # LoraModel.set_adapter accepts a list and sums the active adapters' deltas
+        m.base_model.set_adapter(adapter_names)
+    yield
+
+def shared_prefix_len(token_lists):
+    """Longest common token prefix, leaving at least one token of every prompt uncached."""
+    n=min(len(t) for t in token_lists)-1
+    for i in range(max(0,n)):
+        if any(t[i]!=token_lists[0][i] for t in token_lists):
+            return i
+    return max(0,n)
+
+def _first_token_timer():
+    from transformers import StoppingCriteria
+    import torch
+
+    class FirstTokenTimer(StoppingCriteria):
+        """Never stops generation; records when the first new token was produced."""
+        first=None
+        def __call__(self, input_ids, scores, **kwargs):
+            if self.first is None:
+                self.first=time.perf_counter()
+            return torch.zeros(input_ids.shape[0],dtype=torch.bool,device=input_ids.device)
+
+    return FirstTokenTimer()
+
+def prefix_cache(m, prefix):
+    """KV cache of the shared prefix under the active adapters (batch size 1, legacy format)."""
+    import torch
+
+    ids=torch.tensor([prefix],device=m.device)
+    out=m(input_ids=ids,use_cache=True)
+    pkv=out.past_key_values
+    return pkv.to_legacy_cache() if hasattr(pkv,"to_legacy_cache") else pkv
+
+def generate_batch(tokenizer, m, batch_ids, prefix_len, cached, max_new_tokens):
+    """
+    Generate for one batch. Prompts are left-padded after the shared prefix,
+    so [prefix | pad... | suffix] with the pads masked out; when a prefix KV
+    cache is given only the suffixes are run through the model.
+    """
+    import torch
+    from transformers import DynamicCache, StoppingCriteriaList
+
+    pad=tokenizer.pad_token_id
+    prefix=batch_ids[0][:prefix_len]
+    suffixes=[ids[prefix_len:] for ids in batch_ids]
+    width=max(len(x) for x in suffixes)
+    input_ids=[prefix+[pad]*(width-len(x))+x for x in suffixes]
+    mask=[[1]*prefix_len+[0]*(width-len(x))+[1]*len(x) for x in suffixes]
+
+    kwargs={}
+    if cached is not None:
+        b=len(batch_ids)
+        kwargs["past_key_values"]=DynamicCache.from_legacy_cache(tuple(
+            (k.expand(b,-1,-1,-1).contiguous(),v.expand(b,-1,-1,-1).contiguous()) for k,v in cached
+        ))
+
+    timer=_first_token_timer()
+    start=time.perf_counter()
+    out=m.generate(
+        input_ids=torch.tensor(input_ids,device=m.device),
+        attention_mask=torch.tensor(mask,device=m.device),
+        max_new_tokens=max_new_tokens,
+        pad_token_id=pad,
+        stopping_criteria=StoppingCriteriaList([timer]),
+        **kwargs,
+    )
+    end=time.perf_counter()
+
+    rows=[]
+    for i,row in enumerate(out):
+        new=row[len(input_ids[i]):].tolist()
+        if tokenizer.eos_token_id in new:
+            new=new[:new.index(tokenizer.eos_token_id)+1]
+        total=end-start
+        rows.append({
+            "response":tokenizer.decode(batch_ids[i]+new,skip_special_tokens=True),
+            "prompt_tokens":len(batch_ids[i]),
+            "generated_tokens":len(new),
+            "ttft_s":round((timer.first or end)-start,4),
+            "tokens_per_sec":round(len(new)/total,2) if total>0 else None,
+        })
+    return rows
+
+def run_scenario(tokenizer, m, name, adapter_names, prompts, batch_size=8, max_new_tokens=256, reuse_prefix=True):
+    import torch
+
+    token_lists=[tokenizer(p)["input_ids"] for p in prompts]
+    prefix_len=shared_prefix_len(token_lists) if reuse_prefix and len(prompts)>1 else 0
+    if prefix_len<MIN_PREFIX_TOKENS:
+        prefix_len=0
+
+    # Similar lengths share a batch to keep padding small; results keep prompt order
+    order=sorted(range(len(prompts)),key=lambda i:len(token_lists[i]))
+    results=[None]*len(prompts)
+    with scenario(m,adapter_names), torch.inference_mode():
+        cached=None
+        if prefix_len:
+            start=time.perf_counter()
+            cached=prefix_cache(m,token_lists[0][:prefix_len])
+            print(f"  {name}: cached {prefix_len} shared prefix tokens in {time.perf_counter()-start:.2f}s")
+
+        for i in range(0,len(order),batch_size):
+            idx=order[i:i+batch_size]
+            rows=generate_batch(tokenizer,m,[token_lists[j] for j in idx],prefix_len,cached,max_new_tokens)
+            for j,row in zip(idx,rows):
+                results[j]={"scenario":name,"prompt":prompts[j],**row,"batch_size":len(idx),"prefix_cached_tokens":prefix_len}
     return results
 
-def main():
-    scenarios={
-        "base":[],
-        "level1":["/workspace/peft/level1"],
-        "level2":["/workspace/peft/level2"],
-        "level3":["/workspace/peft/level3"],
-    }
+def iter_heldout(path, tokenizer, max_length, max_chunks=None):
+    """Stream token id lists of held-out chunks, truncated to max_length."""
+    n=0
+    with open(path,encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            ids=tokenizer(json.loads(line)["text"])["input_ids"][:max_length]
+            if len(ids)<2:
+                continue
+            yield ids
+            n+=1
+            if max_chunks and n>=max_chunks:
+                return
+
+def token_batches(seqs, token_budget):
+    """Group sequences so that batch size x longest sequence (padded tokens) stays within the budget."""
+    batch,width=[],0
+    for ids in seqs:
+        w=max(width,len(ids))
+        if batch and w*(len(batch)+1)>token_budget:
+            yield batch
+            batch,w=[],len(ids)
+        batch.append(ids)
+        width=w
+    if batch:
+        yield batch
+
+def batch_nll(m, batch, pad):
+    """Summed next-token negative log-likelihood and the number of predicted tokens."""
+    import torch
+    import torch.nn.functional as F
+
+    width=max(len(x) for x in batch)
+    ids=torch.tensor([x+[pad]*(width-len(x)) for x in batch],device=m.device)
+    mask=torch.tensor([[1]*len(x)+[0]*(width-len(x)) for x in batch],device=m.device)
+    logits=m(input_ids=ids,attention_mask=mask).logits[:,:-1]
+    target=mask[:,1:].bool()
+    nll=F.cross_entropy(logits[target].float(),ids[:,1:][target],reduction="sum")
+    return nll.item(),int(target.sum())
+
+def run_perplexity(args, scenarios):
+    """Loss/perplexity of every scenario on the held-out chunks, one model load, one pass over the data."""
+    import torch
+
+    if not os.path.exists(args.heldout):
+        print(f"Held-out set not found: {args.heldout} (build it with build_dataset.py --holdout-pct 5)")
+        return 1
+    adapter_paths=sorted({ad for ads in scenarios.values() for ad in ads})
+    start=time.perf_counter()
+    tokenizer,m,names=load_model(adapter_paths,args.base,args.device)
+    print(f"Loaded {args.base} and {len(names)} adapter(s) in {time.perf_counter()-start:.1f}s")
+
+    totals={s:{"nll":0.0,"tokens":0,"seconds":0.0} for s in scenarios}
+    chunks=batches=0
+    seqs=iter_heldout(args.heldout,tokenizer,args.max_length,args.max_chunks)
+    with torch.inference_mode():
+        for batch in token_batches(seqs,args.token_budget):
+            chunks+=len(batch)
+            batches+=1
+            for s,ad in scenarios.items():
+                start=time.perf_counter()
+                with scenario(m,[names[a] for a in ad]):
+                    nll,n=batch_nll(m,batch,tokenizer.pad_token_id)
+                totals[s]["nll"]+=nll
+                totals[s]["tokens"]+=n
+                totals[s]["seconds"]+=time.perf_counter()-start
+            if batches%10==0:
+                print(f"  {chunks} chunks, {totals[next(iter(scenarios))]['tokens']} tokens")
+
+    report={"heldout":args.heldout,"base":args.base,"chunks":chunks,"max_length":args.max_length,"scenarios":{}}
+    for s,t in totals.items():
+        loss=t["nll"]/t["tokens"] if t["tokens"] else None
+        report["scenarios"][s]={"loss":loss,"perplexity":math.exp(loss) if loss is not None else None,
+                                "tokens":t["tokens"],"seconds":round(t["seconds"],2)}
+    base_ppl=report["scenarios"].get("base",{}).get("perplexity")
+    for r in report["scenarios"].values():
+        r["vs_base_pct"]=round((r["perplexity"]/base_ppl-1)*100,2) if base_ppl and r["perplexity"] else None
+
+    out=args.out
+    os.makedirs(os.path.dirname(out) or ".",exist_ok=True)
+    with open(out,"w") as w:
+        json.dump(report,w,indent=2)
+
+    print(f"\nPerplexity on {chunks} held-out chunks:")
+    print(f"  {'scenario':32s} {'loss':>8s} {'ppl':>10s} {'vs base':>9s} {'tokens':>9s}")
+    for s,r in sorted(report["scenarios"].items(),key=lambda kv:kv[1]["loss"] if kv[1]["loss"] is not None else math.inf):
+        if r["loss"] is None:
+            print(f"  {s:32s} {'-':>8s}")
+            continue
+        delta="-" if r["vs_base_pct"] is None else f"{r['vs_base_pct']:+.1f}%"
+        print(f"  {s:32s} {r['loss']:8.4f} {r['perplexity']:10.3f} {delta:>9s} {r['tokens']:9d}")
+    print(f"Report: {out}")
+    return 0
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Evaluate the base model and each LoRA level on the eval prompts.")
+    parser.add_argument("--batch-size",type=int,default=8,help="Prompts generated together (left-padded)")
+    parser.add_argument("--max-new-tokens",type=int,default=256)
+    parser.add_argument("--system-prompt",help="Shared text prepended to every prompt; its KV cache is computed once per scenario")
+    parser.add_argument("--no-prefix-cache",action="store_true",help="Do not reuse the KV cache of a shared prompt prefix")
+    parser.add_argument("--cache",action="store_true",help="Reuse stored responses when the model, adapters and prompts are unchanged (generation is greedy)")
+    parser.add_argument("--adapters",nargs="+",help="PEFT adapter folders to evaluate instead of level1-3 (the base model is always included)")
+    parser.add_argument("--perplexity",action="store_true",help="Score held-out chunks instead of generating from PROMPTS")
+    parser.add_argument("--heldout",default=HELDOUT,help="Held-out JSONL with a text field (build_dataset.py --holdout-pct)")
+    parser.add_argument("--token-budget",type=int,default=4096,help="Padded tokens per perplexity batch")
+    parser.add_argument("--max-length",type=int,default=1024,help="Tokens kept per held-out chunk")
+    parser.add_argument("--max-chunks",type=int,help="Stop after this many held-out chunks")
+    parser.add_argument("--out",default=PERPLEXITY_OUT,help="Perplexity report path")
+    parser.add_argument("--base",default=HF,help="Base HF model (a tiny model works for CPU smoke tests)")
+    parser.add_argument("--device",default="auto",help="device_map for the model, e.g. auto or cpu")
+    args=parser.parse_args(argv)
+
+    prompts=[f"{args.system_prompt}\n\n{p}" if args.system_prompt else p for p in PROMPTS]
+
+    candidates={"base":[],**{os.path.basename(a.rstrip("/")):[a] for a in args.adapters}} if args.adapters else SCENARIOS
+    scenarios={}
+    for s,ad in candidates.items():
+        missing=[a for a in ad if not os.path.isdir(a)]
+        if missing:
+            print(f"Skipping scenario {s}: {', '.join(missing)} not found")
+            continue
+        scenarios[s]=ad
+    if args.perplexity:
+        return run_perplexity(args,scenarios)
+
+    # Greedy decoding is deterministic, so identical (model, adapters, prompt) runs can be served from the cache
+    cache=keys=None
+    results={s:[None]*len(prompts) for s in scenarios}
+    if args.cache:
+        import response_cache
+        cache=response_cache.ResponseCache()
+        # Left-padded batched greedy output can depend on batch composition and prefix reuse
+        params={"generator":"transformers","max_new_tokens":args.max_new_tokens,"temp":0,
+                "batch_size":args.batch_size,"prefix_cache":not args.no_prefix_cache}
+        keys={s:[cache.key(args.base,[(a,1.0) for a in ad],p,params) for p in prompts] for s,ad in scenarios.items()}
+        for s in scenarios:
+            for i,k in enumerate(keys[s]):
+                hit=cache.get(k)
+                if hit is not None:
+                    results[s][i]={**hit,"cached":True}
+
+    todo={s:[i for i,r in enumerate(results[s]) if r is None] for s in scenarios}
+    if any(todo.values()):
+        adapter_paths=sorted({ad for s,ads in scenarios.items() if todo[s] for ad in ads})
+        start=time.perf_counter()
+        tokenizer,m,names=load_model(adapter_paths,args.base,args.device)
+        print(f"Loaded base model and {len(names)} adapter(s) in {time.perf_counter()-start:.1f}s")
+
+        for s,ad in scenarios.items():
+            if not todo[s]:
+                continue
+            start=time.perf_counter()
+            rows=run_scenario(tokenizer,m,s,[names[a] for a in ad],[prompts[i] for i in todo[s]],
+                              args.batch_size,args.max_new_tokens,not args.no_prefix_cache)
+            for i,r in zip(todo[s],rows):
+                results[s][i]=r
+                if cache and r["response"].strip():
+                    cache.put(keys[s][i],r)
+            print(f"Scenario {s}: {time.perf_counter()-start:.1f}s")
+
     out="/workspace/eval/eval.jsonl"
     os.makedirs("/workspace/eval",exist_ok=True)
     with open(out,"w") as w:
-        for s,ad in scenarios.items():
-            for r in run_scenario(s,ad):
+        for s in scenarios:
+            for r in results[s]:
                 w.write(json.dumps(r)+"\n")
+    if cache:
+        cache.report()
+        cache.close()
 
 if __name__=="__main__":
-    main()
+    raise SystemExit(main())
@@ -4,6 +4,8 @@ import os
 import glob
 import shlex
 
+import gguf_catalog
+
 LLAMA_CPP_DIR = "/workspace/llama.cpp"
 EXPORT_BIN = f"{LLAMA_CPP_DIR}/build/bin/llama-export-lora"
 CONVERT_LORA_PY = f"{LLAMA_CPP_DIR}/convert_lora_to_gguf.py"
@@ -17,6 +19,12 @@ def run(cmd):
         print(f"Error executing command: {e}")
         return False
 
+def record_export(output_path):
+    """Catalog a freshly written GGUF with its hash, the reference for later integrity checks."""
+    entry = gguf_catalog.refresh([output_path], with_hash=True)[0]
+    if not entry["valid"]:
+        print(f"Warning: exported file failed header check: {entry['error']}")
+
 def export_single_adapter(lora_path, output_path, base_model_path=None):
     """
     Attempts to export a PEFT adapter to GGUF format.
@@ -27,7 +35,10 @@ def export_single_adapter(lora_path, output_path, base_model_path=None):
     if os.path.exists(EXPORT_BIN) and base_model_path and base_model_path.endswith(".gguf"):
         print(f"Attempting binary export for {lora_path}...")
         cmd = f"{shlex.quote(EXPORT_BIN)} -m {shlex.quote(base_model_path)} -o {shlex.quote(output_path)} {shlex.quote(lora_path)}"
+        if os.environ.get("OMP_NUM_THREADS"):
+            cmd += f" -t {shlex.quote(os.environ['OMP_NUM_THREADS'])}"
         if run(cmd):
+            record_export(output_path)
             return True
 
     # Strategy 2: Use python conversion script
@@ -36,24 +47,26 @@ def export_single_adapter(lora_path, output_path, base_model_path=None):
         # Explicitly point to the local HF model to avoid HFValidationError
         cmd = f"python3 {shlex.quote(CONVERT_LORA_PY)} {shlex.quote(lora_path)} --outfile {shlex.quote(output_path)} --base /workspace/models/hf_mistral"
         if run(cmd):
+            record_export(output_path)
             return True
 
     print(f"Failed to export adapter: {lora_path}")
     return False
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Export PEFT adapters to GGUF format.")
     parser.add_argument("--adapters_dir", default="/workspace/output/peft", help="Directory containing PEFT adapter folders")
     parser.add_argument("--output_dir", default="/workspace/output/adapters_gguf/v3", help="Directory to save GGUF adapters")
     parser.add_argument("--base_model", help="Path to base GGUF model (optional, for binary export)")
     parser.add_argument("--single_adapter", help="Path to a single PEFT adapter folder")
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.single_adapter:
         name = os.path.basename(args.single_adapter.rstrip("/"))
         output_path = os.path.join(args.output_dir, f"{name}.gguf")
-        export_single_adapter(args.single_adapter, output_path, args.base_model)
+        if not export_single_adapter(args.single_adapter, output_path, args.base_model):
+            return 1
     else:
         # Batch mode
         adapter_paths = [d for d in glob.glob(os.path.join(args.adapters_dir, "*")) if os.path.isdir(d)]
@@ -62,6 +75,7 @@ def main():
             return
 
         print(f"Found {len(adapter_paths)} adapters. Starting batch export...")
+        failed = []
         for ap in adapter_paths:
             name = os.path.basename(ap.rstrip("/"))
             # Skip 'merged' or other non-adapter dirs if necessary
@@ -69,8 +83,12 @@ def main():
             
             output_path = os.path.join(args.output_dir, f"{name}.gguf")
             print(f"\n>>> Exporting {name}...")
-            export_single_adapter(ap, output_path, args.base_model)
+            if not export_single_adapter(ap, output_path, args.base_model):
+                failed.append(name)
+        if failed:
+            print(f"\n❌ Export failed for: {', '.join(failed)}")
+            return 1
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
 
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""
+Catalog of GGUF models and adapters.
+
+Headers and tensor-info tables are parsed through mmap without reading any
+tensor data, and the results are kept in a persistent JSON index keyed by
+absolute path. Entries are only re-parsed when a file's size or mtime
+changes, so listing and validating a directory of adapters is near-instant.
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+CATALOG_PATH = os.environ.get("GGUF_CATALOG_PATH", "/workspace/output/gguf_catalog.json")
+DEFAULT_ADAPTERS_DIR = "/workspace/output/adapters_gguf/v3"
+
+GGUF_MAGIC = b"GGUF"
+DEFAULT_ALIGNMENT = 32
+HASH_CHUNK = 8 * 1024 * 1024
+
+# Compatibility problems listed per adapter before the rest are summarised
+MAX_REPORTED_PROBLEMS = 5
+
+# Metadata arrays longer than this (e.g. tokenizer vocabularies) are recorded by length only
+MAX_ARRAY_ITEMS = 64
+
+# GGUF metadata value types
+_SCALAR_FORMATS = {
+    0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i",
+    6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d",
+}
+_STRING = 8
+_ARRAY = 9
+
+# ggml tensor type id -> (name, elements per block, bytes per block)
+GGML_TYPES = {
+    0: ("F32", 1, 4),
+    1: ("F16", 1, 2),
+    2: ("Q4_0", 32, 18),
+    3: ("Q4_1", 32, 20),
+    6: ("Q5_0", 32, 22),
+    7: ("Q5_1", 32, 24),
+    8: ("Q8_0", 32, 34),
+    9: ("Q8_1", 32, 36),
+    10: ("Q2_K", 256, 84),
+    11: ("Q3_K", 256, 110),
+    12: ("Q4_K", 256, 144),
+    13: ("Q5_K", 256, 176),
+    14: ("Q6_K", 256, 210),
+    15: ("Q8_K", 256, 292),
+    16: ("IQ2_XXS", 256, 66),
+    17: ("IQ2_XS", 256, 74),
+    18: ("IQ3_XXS", 256, 98),
+    19: ("IQ1_S", 256, 50),
+    20: ("IQ4_NL", 32, 18),
+    21: ("IQ3_S", 256, 110),
+    22: ("IQ2_S", 256, 82),
+    23: ("IQ4_XS", 256, 136),
+    24: ("I8", 1, 1),
+    25: ("I16", 1, 2),
+    26: ("I32", 1, 4),
+    27: ("I64", 1, 8),
+    28: ("F64", 1, 8),
+    29: ("IQ1_M", 256, 56),
+    30: ("BF16", 1, 2),
+}
+
+LORA_SUFFIXES = (".lora_a", ".lora_b")
+
+
+class GGUFError(ValueError):
+    """Raised when a file is not a readable GGUF or is truncated."""
+
+
+class _Reader:
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def _need(self, size):
+        if self.pos + size > len(self.buf):
+            raise GGUFError(f"header truncated at byte {self.pos}")
+
+    def unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        self._need(size)
+        (value,) = struct.unpack_from(fmt, self.buf, self.pos)
+        self.pos += size
+        return value
+
+    def string(self):
+        length = self.unpack("<Q")
+        self._need(length)
+        value = bytes(self.buf[self.pos:self.pos + length]).decode("utf-8", errors="replace")
+        self.pos += length
+        return value
+
+    def skip_string(self):
+        length = self.unpack("<Q")
+        self._need(length)
+        self.pos += length
+
+    def value(self, vtype):
+        if vtype in _SCALAR_FORMATS:
+            return self.unpack(_SCALAR_FORMATS[vtype])
+        if vtype == _STRING:
+            return self.string()
+        if vtype == _ARRAY:
+            item_type = self.unpack("<I")
+            count = self.unpack("<Q")
+            if count <= MAX_ARRAY_ITEMS:
+                return [self.value(item_type) for _ in range(count)]
+            self.skip_array(item_type, count)
+            return {"array_len": count}
+        raise GGUFError(f"unknown metadata value type {vtype}")
+
+    def skip_array(self, item_type, count):
+        if item_type in _SCALAR_FORMATS:
+            size = struct.calcsize(_SCALAR_FORMATS[item_type]) * count
+            self._need(size)
+            self.pos += size
+        elif item_type == _STRING:
+            for _ in range(count):
+                self.skip_string()
+        else:
+            for _ in range(count):
+                self.value(item_type)
+
+
+def read_gguf(path):
+    """
+    Parse a GGUF file's metadata and tensor-info table.
+
+    Returns a dict with version, metadata, tensors ({name: {shape, type,
+    offset, nbytes}}), data_offset and file_size. Raises GGUFError if the
+    header is malformed or the file is too short for its tensor data.
+    """
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size < 24:
+            raise GGUFError(f"file too small for a GGUF header ({file_size} bytes)")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            r = _Reader(mm)
+            if r.buf[:4] != GGUF_MAGIC:
+                raise GGUFError("bad magic, not a GGUF file")
+            r.pos = 4
+            version = r.unpack("<I")
+            if version < 2:
+                raise GGUFError(f"unsupported GGUF version {version}")
+            tensor_count = r.unpack("<Q")
+            kv_count = r.unpack("<Q")
+
+            metadata = {}
+            for _ in range(kv_count):
+                key = r.string()
+                metadata[key] = r.value(r.unpack("<I"))
+
+            tensors = {}
+            for _ in range(tensor_count):
+                name = r.string()
+                n_dims = r.unpack("<I")
+                shape = [r.unpack("<Q") for _ in range(n_dims)]
+                type_id = r.unpack("<I")
+                offset = r.unpack("<Q")
+                tensors[name] = {
+                    "shape": shape,
+                    "type": GGML_TYPES.get(type_id, (f"type{type_id}",))[0],
+                    "offset": offset,
+                    "nbytes": tensor_nbytes(shape, type_id),
+                }
+            header_end = r.pos
+
+    alignment = metadata.get("general.alignment", DEFAULT_ALIGNMENT) or DEFAULT_ALIGNMENT
+    data_offset = header_end + (-header_end % alignment)
+
+    known = [t["offset"] + t["nbytes"] for t in tensors.values() if t["nbytes"] is not None]
+    required = data_offset + max(known, default=0)
+    if file_size < required:
+        raise GGUFError(f"truncated: tensor data needs {required} bytes, file has {file_size}")
+
+    return {
+        "version": version,
+        "metadata": metadata,
+        "tensors": tensors,
+        "data_offset": data_offset,
+        "file_size": file_size,
+    }
+
+
+def tensor_nbytes(shape, type_id):
+    """Size of a tensor's data in bytes, or None for an unknown ggml type."""
+    if type_id not in GGML_TYPES:
+        return None
+    _, block, block_bytes = GGML_TYPES[type_id]
+    elements = 1
+    for dim in shape:
+        elements *= dim
+    return elements // block * block_bytes
+
+
+def file_sha256(path):
+    """Stream a file through sha256 in fixed-size chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _base_model_identity(metadata):
+    for key in ("general.base_model.0.repo_url", "general.base_model.0.name", "general.basename", "general.name"):
+        if metadata.get(key):
+            return metadata[key]
+    return None
+
+
+def describe(path):
+    """Parse one GGUF file into a catalog entry (never reads tensor data)."""
+    st = os.stat(path)
+    entry = {
+        "path": os.path.abspath(path),
+        "name": os.path.basename(path),
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "sha256": None,
+    }
+    try:
+        info = read_gguf(path)
+    except (GGUFError, OSError, ValueError) as exc:
+        entry.update(valid=False, error=str(exc))
+        return entry
+
+    md = info["metadata"]
+    arch = md.get("general.architecture")
+    tensors = info["tensors"]
+    is_adapter = md.get("general.type") == "adapter" or any(n.endswith(LORA_SUFFIXES) for n in tensors)
+
+    entry.update(
+        valid=True,
+        error=None,
+        version=info["version"],
+        kind="adapter" if is_adapter else "model",
+        architecture=arch,
+        model_name=md.get("general.name"),
+        base_model=_base_model_identity(md),
+        tensor_count=len(tensors),
+        tensors={name: [t["shape"], t["type"]] for name, t in tensors.items()},
+    )
+
+    if is_adapter:
+        ranks = sorted({t["shape"][-1] for n, t in tensors.items() if n.endswith(".lora_a") and t["shape"]})
+        targets = set()
+        for n in tensors:
+            if n.endswith(LORA_SUFFIXES):
+                # blk.12.attn_q.weight.lora_a -> attn_q
+                parts = n[:-len(".lora_a")].split(".")
+                targets.add(parts[2] if parts[0] == "blk" and len(parts) > 2 else ".".join(parts))
+        entry.update(
+            adapter_type=md.get("adapter.type"),
+            lora_rank=ranks[0] if len(ranks) == 1 else ranks,
+            lora_alpha=md.get("adapter.lora.alpha"),
+            target_tensors=sorted(targets),
+        )
+    elif arch:
+        entry.update(
+            block_count=md.get(f"{arch}.block_count"),
+            hidden_size=md.get(f"{arch}.embedding_length"),
+            file_type=md.get("general.file_type"),
+        )
+    return entry
+
+
+def check_compat(adapter, base):
+    """
+    Cross-check an adapter entry's LoRA tensors against a base model entry.
+
+    Every X.lora_a / X.lora_b pair must have a matching base tensor X with
+    shape [in, out] where lora_a is [in, r] and lora_b is [r, out]. Returns
+    a list of problems; an empty list means the adapter can be applied.
+    """
+    if not adapter["valid"]:
+        return [adapter["error"]]
+    if not base["valid"]:
+        return [f"base model unreadable: {base['error']}"]
+    if adapter["kind"] != "adapter":
+        return ["not a LoRA adapter"]
+
+    problems = []
+    if adapter["architecture"] and base["architecture"] and adapter["architecture"] != base["architecture"]:
+        problems.append(f"architecture {adapter['architecture']} != base {base['architecture']}")
+
+    pairs = {}
+    for name, (shape, _) in adapter["tensors"].items():
+        if name.endswith(LORA_SUFFIXES):
+            pairs.setdefault(name[:-len(".lora_a")], {})[name[-1]] = shape
+
+    base_tensors = base["tensors"]
+    for target, halves in sorted(pairs.items()):
+        if set(halves) != {"a", "b"}:
+            problems.append(f"{target}: missing lora_{'b' if 'a' in halves else 'a'}")
+            continue
+        a, b = halves["a"], halves["b"]
+        if target not in base_tensors:
+            problems.append(f"{target}: no such tensor in base model")
+            continue
+        if len(a) != 2 or len(b) != 2 or a[1] != b[0]:
+            problems.append(f"{target}: lora_a {a} and lora_b {b} disagree on rank")
+            continue
+        base_shape = base_tensors[target][0]
+        if [a[0], b[1]] != base_shape[:2]:
+            problems.append(f"{target}: adapter delta {a[0]}x{b[1]} != base {base_shape[0]}x{base_shape[1]}")
+
+    if len(problems) > MAX_REPORTED_PROBLEMS:
+        extra = len(problems) - MAX_REPORTED_PROBLEMS
+        problems = problems[:MAX_REPORTED_PROBLEMS] + [f"... and {extra} more"]
+    return problems
+
+
+def load_catalog(catalog_path=CATALOG_PATH):
+    try:
+        with open(catalog_path) as f:
+            catalog = json.load(f)
+        if isinstance(catalog.get("files"), dict):
+            return catalog
+    except (OSError, ValueError):
+        pass
+    return {"version": 1, "files": {}}
+
+
+def save_catalog(catalog, catalog_path=CATALOG_PATH):
+    try:
+        os.makedirs(os.path.dirname(catalog_path) or ".", exist_ok=True)
+        tmp = f"{catalog_path}.tmp.{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(catalog, f)
+        os.replace(tmp, catalog_path)
+    except OSError as exc:
+        print(f"⚠ Could not write GGUF catalog {catalog_path}: {exc}")
+
+
+def refresh(paths, with_hash=False, catalog_path=CATALOG_PATH):
+    """
+    Return catalog entries for paths, re-parsing only new or changed files.
+
+    Entries whose file has disappeared are dropped from the index. With
+    with_hash, a sha256 is computed once per file version and kept.
+    """
+    catalog = load_catalog(catalog_path)
+    files = catalog["files"]
+    changed = False
+
+    for stale in [p for p in files if not os.path.exists(p)]:
+        del files[stale]
+        changed = True
+
+    entries = []
+    for path in paths:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = files.get(path)
+        if entry is None or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns:
+            entry = describe(path)
+            files[path] = entry
+            changed = True
+        if with_hash and entry.get("sha256") is None:
+            entry["sha256"] = file_sha256(path)
+            changed = True
+        entries.append(entry)
+
+    if changed:
+        save_catalog(catalog, catalog_path)
+    return entries
+
+
+def verify_hashes(paths, workers=None, catalog_path=CATALOG_PATH):
+    """
+    Re-hash files in parallel and compare against the hashes in the index.
+
+    Returns {path: (status, sha256)} where status is "ok", "recorded" (no
+    previous hash for this file version, now stored) or "mismatch" (content
+    changed while size and mtime did not, i.e. on-disk corruption).
+    """
+    entries = refresh(paths, catalog_path=catalog_path)
+    with ThreadPoolExecutor(max_workers=workers or min(8, (os.cpu_count() or 1) + 1)) as pool:
+        digests = list(pool.map(file_sha256, [e["path"] for e in entries]))
+
+    catalog = load_catalog(catalog_path)
+    results = {}
+    for entry, digest in zip(entries, digests):
+        recorded = entry.get("sha256")
+        if recorded is None:
+            status = "recorded"
+            if entry["path"] in catalog["files"]:
+                catalog["files"][entry["path"]]["sha256"] = digest
+        else:
+            status = "ok" if recorded == digest else "mismatch"
+        results[entry["path"]] = (status, digest)
+
+    if any(status == "recorded" for status, _ in results.values()):
+        save_catalog(catalog, catalog_path)
+    return results
+
+
+def scan_dir(directory, with_hash=False, catalog_path=CATALOG_PATH):
+    """Catalog entries for every .gguf file in a directory, sorted by name."""
+    if not directory or not os.path.isdir(directory):
+        return []
+    paths = [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.lower().endswith(".gguf")
+    ]
+    return refresh(paths, with_hash=with_hash, catalog_path=catalog_path)
+
+
+def print_entries(entries):
+    print(f"  {'name':34s} {'kind':8s} {'arch':8s} {'rank':>5s} {'alpha':>6s} {'tensors':>8s} {'size MB':>9s}  status")
+    for e in entries:
+        if not e["valid"]:
+            print(f"  {e['name']:34s} {'?':8s} {'?':8s} {'':>5s} {'':>6s} {'':>8s} {e['size'] / 2**20:9.2f}  ✗ {e['error']}")
+            continue
+        rank = e.get("lora_rank", "")
+        alpha = e.get("lora_alpha")
+        print(
+            f"  {e['name']:34s} {e['kind']:8s} {str(e['architecture']):8s} {str(rank):>5s} "
+            f"{'' if alpha is None else f'{alpha:g}':>6s} {e['tensor_count']:8d} {e['size'] / 2**20:9.2f}  ✓"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List and validate GGUF models/adapters from their headers.")
+    parser.add_argument("paths", nargs="*", default=[DEFAULT_ADAPTERS_DIR], help="GGUF files or directories")
+    parser.add_argument("--hash", action="store_true", help="Also compute (and cache) sha256 content hashes")
+    parser.add_argument("--json", action="store_true", help="Print entries as JSON")
+    parser.add_argument("--catalog", default=CATALOG_PATH, help="Path of the persistent index")
+    args = parser.parse_args(argv)
+
+    entries = []
+    for p in args.paths:
+        if os.path.isdir(p):
+            entries += scan_dir(p, with_hash=args.hash, catalog_path=args.catalog)
+        elif os.path.exists(p):
+            entries += refresh([p], with_hash=args.hash, catalog_path=args.catalog)
+        else:
+            print(f"✗ Not found: {p}")
+
+    if args.json:
+        print(json.dumps(entries, indent=2))
+    else:
+        print_entries(entries)
+
+    return 0 if entries and all(e["valid"] for e in entries) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
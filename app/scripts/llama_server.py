@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Persistent llama.cpp server backend for adapter sweeps.
+
+Starts one llama-server with the base GGUF and every adapter preloaded via
+--lora-init-without-apply, then switches adapters and scales through
+POST /lora-adapters between requests. The base model is loaded once per
+sweep instead of once per adapter.
+"""
+import json
+import os
+import shlex
+import socket
+import subprocess
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+SERVER_BINARIES = [
+    "/workspace/llama.cpp/build/bin/llama-server",
+    "/workspace/llama.cpp/build/bin/server",
+    "/workspace/llama.cpp/llama-server",
+]
+DEFAULT_HOST = "127.0.0.1"
+STARTUP_TIMEOUT = 600
+REQUEST_TIMEOUT = 600
+
+
+def find_server_binary():
+    for p in SERVER_BINARIES:
+        if os.path.exists(p):
+            return p
+    return None
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((DEFAULT_HOST, 0))
+        return s.getsockname()[1]
+
+
+class LlamaServer:
+    """A llama-server child process with all adapters loaded at scale 0."""
+
+    def __init__(self, model, adapters=(), ngl=0, ctx=None, threads=None,
+                 host=DEFAULT_HOST, port=None, binary=None, extra_args=()):
+        self.model = model
+        self.adapters = [os.path.abspath(a) for a in adapters]
+        self.ngl = ngl
+        self.ctx = ctx
+        self.threads = threads
+        self.host = host
+        self.port = port or free_port()
+        self.binary = binary or find_server_binary()
+        self.extra_args = list(extra_args)
+        self.proc = None
+        self.log = None
+        self.load_seconds = None
+        self.adapter_ids = {}
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def command(self):
+        cmd = [self.binary, "-m", self.model, "--host", self.host, "--port", str(self.port)]
+        for adapter in self.adapters:
+            cmd += ["--lora", adapter]
+        if self.adapters:
+            cmd.append("--lora-init-without-apply")
+        if self.ngl and self.ngl > 0:
+            cmd += ["-ngl", str(self.ngl)]
+        if self.ctx:
+            cmd += ["-c", str(self.ctx)]
+        if self.threads:
+            cmd += ["-t", str(self.threads)]
+        return cmd + self.extra_args
+
+    def start(self):
+        if not self.binary:
+            raise RuntimeError("llama-server binary not found in /workspace/llama.cpp/build/bin/")
+
+        cmd = self.command()
+        print(f"Starting llama-server: {' '.join(shlex.quote(c) for c in cmd)}")
+        # Server output goes to a file so a chatty server can never block on a full pipe
+        self.log = tempfile.NamedTemporaryFile(prefix="llama-server-", suffix=".log", delete=False)
+        start = time.perf_counter()
+        self.proc = subprocess.Popen(cmd, stdout=self.log, stderr=subprocess.STDOUT)
+
+        deadline = start + STARTUP_TIMEOUT
+        while True:
+            if self.proc.poll() is not None:
+                tail = self.log_tail()
+                self.stop()
+                raise RuntimeError(f"llama-server exited with code {self.proc.returncode}:\n{tail}")
+            try:
+                self.request("GET", "/health", timeout=5)
+                break
+            except (urllib.error.URLError, ConnectionError, OSError):
+                # 503 while the model is loading, connection refused before the socket is up
+                pass
+            if time.perf_counter() > deadline:
+                tail = self.log_tail()
+                self.stop()
+                raise RuntimeError(f"llama-server not ready after {STARTUP_TIMEOUT}s:\n{tail}")
+            time.sleep(0.25)
+        self.load_seconds = time.perf_counter() - start
+
+        if self.adapters:
+            loaded = self.request("GET", "/lora-adapters")
+            self.adapter_ids = {os.path.abspath(a["path"]): a["id"] for a in loaded}
+        return self
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        if self.log:
+            self.log.close()
+            os.unlink(self.log.name)
+            self.log = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def log_tail(self, lines=20):
+        if not self.log:
+            return ""
+        self.log.flush()
+        with open(self.log.name, errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+
+    def request(self, method, path, body=None, timeout=REQUEST_TIMEOUT):
+        data = None if body is None else json.dumps(body).encode()
+        req = urllib.request.Request(
+            self.url + path, data=data, method=method,
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read() or b"null")
+
+    def set_adapters(self, scales):
+        """Apply {adapter_path: scale}; every other preloaded adapter is set to 0."""
+        scales = {os.path.abspath(p): s for p, s in scales.items()}
+        unknown = set(scales) - set(self.adapter_ids)
+        if unknown:
+            raise ValueError(f"Adapters not preloaded: {', '.join(sorted(unknown))}")
+        body = [{"id": i, "scale": scales.get(path, 0.0)} for path, i in self.adapter_ids.items()]
+        if body:
+            self.request("POST", "/lora-adapters", body)
+
+    def complete(self, prompt, max_tokens=256, temp=0.7, **params):
+        """Run one /completion request; returns the server response plus wall seconds."""
+        body = {
+            "prompt": prompt,
+            "n_predict": max_tokens,
+            "temperature": temp,
+            # Cached prompt KV was computed under the previous adapter scales
+            "cache_prompt": False,
+        }
+        body.update(params)
+        start = time.perf_counter()
+        result = self.request("POST", "/completion", body)
+        result["wall_seconds"] = time.perf_counter() - start
+        return result
+
+    def stream(self, prompt, max_tokens=256, temp=0.7, **params):
+        """Streamed /completion: yields the server's events; the last one has stop=True and timings."""
+        body = {
+            "prompt": prompt,
+            "n_predict": max_tokens,
+            "temperature": temp,
+            "cache_prompt": False,
+            "stream": True,
+        }
+        body.update(params)
+        req = urllib.request.Request(
+            self.url + "/completion", data=json.dumps(body).encode(), method="POST",
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as resp:
+            for line in resp:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                event = json.loads(line[5:])
+                yield event
+                if event.get("stop"):
+                    return
+
+
+def sweep(model, adapters, prompt, max_tokens=256, temp=0.7, ngl=0, include_base=False, seed=None):
+    """
+    Generate with the base model and/or each adapter from a single server.
+
+    Returns a list of result dicts (adapter, ok, switch_s, generate_s,
+    tokens, tokens_per_s, content). Blank output counts as a failure.
+    """
+    results = []
+    with LlamaServer(model, adapters, ngl=ngl) as server:
+        print(f"Base model and {len(adapters)} adapter(s) loaded in {server.load_seconds:.1f}s")
+
+        runs = ([None] if include_base else []) + list(adapters)
+        for adapter in runs:
+            label = "Base model only" if adapter is None else os.path.basename(adapter)
+            print("\n" + "=" * 70)
+            print(f"Testing: {label}")
+            print("=" * 70)
+
+            row = {"adapter": label, "ok": False, "switch_s": None, "generate_s": None,
+                   "tokens": 0, "tokens_per_s": None, "content": ""}
+            try:
+                start = time.perf_counter()
+                server.set_adapters({} if adapter is None else {adapter: 1.0})
+                row["switch_s"] = time.perf_counter() - start
+                params = {} if seed is None else {"seed": seed}
+                res = server.complete(prompt, max_tokens=max_tokens, temp=temp, **params)
+            except (urllib.error.URLError, OSError) as e:
+                print(f"✗ Request failed: {e}")
+                results.append(row)
+                continue
+
+            timings = res.get("timings", {})
+            content = res.get("content", "")
+            row.update(
+                ok=bool(content.strip()),
+                generate_s=res["wall_seconds"],
+                tokens=res.get("tokens_predicted", timings.get("predicted_n", 0)),
+                tokens_per_s=timings.get("predicted_per_second"),
+                content=content,
+            )
+            print(content if row["ok"] else "✗ Empty output")
+            results.append(row)
+
+        load_s = server.load_seconds
+
+    print_sweep_summary(results, load_s)
+    return results
+
+
+def print_sweep_summary(results, load_s):
+    print("\n" + "=" * 70)
+    print("SWEEP SUMMARY")
+    print("=" * 70)
+    print(f"Model load (once): {load_s:.1f}s")
+    print(f"  {'adapter':36s} {'switch':>8s} {'generate':>9s} {'tokens':>7s} {'tok/s':>7s}")
+    for r in results:
+        gen = "-" if r["generate_s"] is None else f"{r['generate_s']:.2f}s"
+        tps = "-" if r["tokens_per_s"] is None else f"{r['tokens_per_s']:.1f}"
+        switch = "-" if r["switch_s"] is None else f"{r['switch_s'] * 1000:.0f}ms"
+        mark = "✓" if r["ok"] else "✗"
+        print(f"{mark} {r['adapter']:36s} {switch:>8s} {gen:>9s} {r['tokens']:7d} {tps:>7s}")
+    total_gen = sum(r["generate_s"] or 0 for r in results)
+    print(f"Total: load {load_s:.1f}s + generate {total_gen:.1f}s")
+    print("=" * 70)
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Concurrent load generator for the OpenAI-compatible chat endpoint.
+
+Replays a prompt set against /v1/chat/completions with streaming, either
+closed-loop (--concurrency requests always in flight) or open-loop
+(Poisson arrivals at --rate requests/s, capped at --concurrency in flight).
+Reports throughput, time to first token, inter-token latency and end-to-end
+latency percentiles, and error rates. With --switch-adapter the adapters
+are changed through POST /lora-adapters halfway through the run: dispatch
+pauses, in-flight requests drain, the swap is timed on an idle server, and
+TTFT of the last requests before it is compared with the first ones after.
+
+Only the standard library is used (asyncio streams, raw HTTP/1.1 with
+chunked SSE), so it runs on the CPU pod as-is. --stub starts a local fake
+server in the same process for testing the tester.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import urlsplit
+
+from script_helpers import BENCH_PROMPTS, DEFAULT_OUT_DIR, parse_weighted, percentile
+
+DEFAULT_URL = "http://127.0.0.1:5000"
+CHAT_PATH = "/v1/chat/completions"
+LORA_PATH = "/lora-adapters"
+REQUEST_TIMEOUT = 300
+
+# Stub server timings (seconds)
+STUB_TTFT = 0.05
+STUB_ITL = 0.01
+STUB_SWAP = 0.2
+
+
+def load_prompts(path=None):
+    """Prompts from a .jsonl file ({"prompt": ...} or {"messages": [...]}) or a text file, one per line."""
+    if not path:
+        return list(BENCH_PROMPTS)
+    prompts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                rec = json.loads(line)
+                prompts.append(rec.get("messages") or rec.get("prompt") or rec.get("instruction"))
+            else:
+                prompts.append(line)
+    return prompts
+
+
+def adapter_body(specs):
+    """
+    Body for POST /lora-adapters from PATH:SCALE or ID:SCALE specs.
+
+    Paths use the {"adapters": [{"path", "scale"}]} form from layering-guide.md;
+    numeric ids use llama-server's [{"id", "scale"}] list. "none" clears all adapters.
+    """
+    if specs == ["none"]:
+        return {"adapters": []}
+    weighted = [parse_weighted(s) for s in specs]
+    if all(path.isdigit() for path, _ in weighted):
+        return [{"id": int(path), "scale": scale} for path, scale in weighted]
+    return {"adapters": [{"path": path, "scale": scale} for path, scale in weighted]}
+
+
+# --- minimal HTTP/1.1 client -------------------------------------------------
+
+async def _open(url):
+    parts = urlsplit(url)
+    if parts.scheme != "http":
+        raise ValueError(f"Only http:// URLs are supported, got {url}")
+    host, port = parts.hostname, parts.port or 80
+    reader, writer = await asyncio.open_connection(host, port)
+    return reader, writer, f"{host}:{port}"
+
+
+async def _send(url, method, path, body, accept="application/json"):
+    reader, writer, host = await _open(url)
+    payload = json.dumps(body).encode()
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Accept: {accept}\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+    )
+    await writer.drain()
+
+    status_line = await reader.readline()
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        writer.close()
+        raise ConnectionError(f"Bad status line: {status_line!r}")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    return reader, writer, status, headers
+
+
+async def _body_chunks(reader, headers):
+    """Yield the response body as it arrives (chunked, Content-Length or read-to-close)."""
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                await reader.readline()
+                return
+            yield await reader.readexactly(size)
+            await reader.readline()
+    elif "content-length" in headers:
+        yield await reader.readexactly(int(headers["content-length"]))
+    else:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            yield data
+
+
+async def post_json(url, path, body):
+    reader, writer, status, headers = await _send(url, "POST", path, body)
+    try:
+        data = b"".join([c async for c in _body_chunks(reader, headers)])
+    finally:
+        writer.close()
+    return status, data
+
+
+async def chat_stream(url, messages, max_tokens, temp):
+    """
+    One streamed chat completion. Every SSE event with non-empty delta content
+    counts as a token; TTFT and inter-token gaps are measured from the request start.
+    """
+    body = {"model": "local", "messages": messages, "max_tokens": max_tokens,
+            "temperature": temp, "stream": True}
+    start = time.perf_counter()
+    stamps, text = [], []
+    reader, writer, status, headers = await _send(url, "POST", CHAT_PATH, body, accept="text/event-stream")
+    try:
+        if status != 200:
+            data = b"".join([c async for c in _body_chunks(reader, headers)])
+            return {"ok": False, "status": status, "error": f"HTTP {status}: {data[:200].decode(errors='replace')}"}
+
+        buffer = b""
+        done = False
+        async for chunk in _body_chunks(reader, headers):
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    done = True
+                    break
+                event = json.loads(data)
+                if event.get("error"):
+                    return {"ok": False, "status": status, "error": str(event["error"])[:200]}
+                for choice in event.get("choices", []):
+                    piece = (choice.get("delta") or {}).get("content") or choice.get("text")
+                    if piece:
+                        stamps.append(time.perf_counter())
+                        text.append(piece)
+            if done:
+                break
+    finally:
+        writer.close()
+
+    end = time.perf_counter()
+    content = "".join(text)
+    result = {
+        "ok": bool(content.strip()),
+        "status": status,
+        "error": None if content.strip() else "empty output",
+        "tokens": len(stamps),
+        "ttft_s": stamps[0] - start if stamps else None,
+        "itl_s": [b - a for a, b in zip(stamps, stamps[1:])],
+        "latency_s": end - start,
+    }
+    return result
+
+
+# --- load generation ---------------------------------------------------------
+
+async def run_load(url, prompts, requests, concurrency=8, rate=None, max_tokens=128, temp=0.0,
+                   switch=None, switch_after=None, timeout=REQUEST_TIMEOUT, seed=42, switch_window=None):
+    """Run the load and return (per-request results, swap record or None, wall seconds)."""
+    rng = random.Random(seed)
+    slots = asyncio.Semaphore(concurrency)
+    results = []
+    swap = None
+    switch_after = requests // 2 if switch_after is None else min(switch_after, requests)
+    halfway = asyncio.Event()
+    # Dispatch is paused (gate cleared) while in-flight requests drain and the switch runs
+    gate = asyncio.Event()
+    gate.set()
+    idle = asyncio.Event()
+    idle.set()
+    active = 0
+    t0 = time.perf_counter()
+
+    async def one(i, prompt):
+        nonlocal active
+        queued = time.perf_counter()
+        async with slots:
+            await gate.wait()
+            active += 1
+            idle.clear()
+            started = time.perf_counter()
+            messages = prompt if isinstance(prompt, list) else [{"role": "user", "content": prompt}]
+            try:
+                r = await asyncio.wait_for(chat_stream(url, messages, max_tokens, temp), timeout)
+            except asyncio.TimeoutError:
+                r = {"ok": False, "status": None, "error": f"timeout after {timeout}s"}
+            except (OSError, ConnectionError, ValueError, asyncio.IncompleteReadError) as e:
+                r = {"ok": False, "status": None, "error": f"{type(e).__name__}: {e}"}
+            active -= 1
+            if not active:
+                idle.set()
+        r.update(index=i, queue_s=started - queued, start_s=started - t0, end_s=time.perf_counter() - t0)
+        results.append(r)
+        if len(results) >= switch_after:
+            halfway.set()
+
+    async def do_switch():
+        nonlocal swap
+        await halfway.wait()
+        gate.clear()
+        drain_start = time.perf_counter()
+        await idle.wait()
+        body = adapter_body(switch)
+        start = time.perf_counter()
+        try:
+            status, data = await asyncio.wait_for(post_json(url, LORA_PATH, body), timeout)
+            error = None if status == 200 else f"HTTP {status}: {data[:200].decode(errors='replace')}"
+        except (asyncio.TimeoutError, OSError, ConnectionError) as e:
+            status, error = None, f"{type(e).__name__}: {e}"
+        end = time.perf_counter()
+        gate.set()
+        swap = {"body": body, "status": status, "error": error, "window": switch_window or concurrency,
+                "drain_s": start - drain_start, "start_s": start - t0, "end_s": end - t0, "swap_s": end - start}
+        print(f"Adapter switch after {switch_after} requests: drained in {swap['drain_s'] * 1000:.0f} ms, "
+              f"swap {swap['swap_s'] * 1000:.0f} ms" + (f" ({error})" if error else ""))
+
+    if switch and switch_after <= 0:
+        halfway.set()
+    tasks = [asyncio.ensure_future(do_switch())] if switch else []
+    for i in range(requests):
+        if rate:
+            await asyncio.sleep(rng.expovariate(rate))
+        tasks.append(asyncio.ensure_future(one(i, prompts[i % len(prompts)])))
+        if rate and (i + 1) % max(1, requests // 10) == 0:
+            print(f"  dispatched {i + 1}/{requests}")
+    await asyncio.gather(*tasks)
+    return sorted(results, key=lambda r: r["index"]), swap, time.perf_counter() - t0
+
+
+def _pcts(values, scale=1000):
+    if not values:
+        return {"p50": None, "p90": None, "p99": None}
+    return {f"p{p}": round(percentile(values, p) * scale, 2) for p in (50, 90, 99)}
+
+
+def summarize(results, swap, wall_s):
+    ok = [r for r in results if r["ok"]]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            key = r["error"].split(":")[0]
+            errors[key] = errors.get(key, 0) + 1
+    tokens = sum(r["tokens"] for r in ok)
+    summary = {
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else None,
+        "errors": errors,
+        "wall_s": round(wall_s, 3),
+        "requests_per_s": round(len(ok) / wall_s, 3) if wall_s else None,
+        "output_tokens_per_s": round(tokens / wall_s, 2) if wall_s else None,
+        "ttft_ms": _pcts([r["ttft_s"] for r in ok if r["ttft_s"] is not None]),
+        "itl_ms": _pcts([gap for r in ok for gap in r["itl_s"]]),
+        "latency_ms": _pcts([r["latency_s"] for r in ok]),
+        "queue_ms": _pcts([r["queue_s"] for r in results]),
+    }
+    if swap:
+        # Requests were drained around the switch, so every one falls on one side of it
+        n = swap["window"]
+        before = sorted((r for r in results if r["end_s"] <= swap["start_s"]), key=lambda r: r["end_s"])[-n:]
+        after = sorted((r for r in results if r["start_s"] >= swap["end_s"]), key=lambda r: r["start_s"])[:n]
+        summary["swap"] = {
+            **swap,
+            "swap_ms": round(swap["swap_s"] * 1000, 2),
+            "drain_ms": round(swap["drain_s"] * 1000, 2),
+            "ttft_ms_before": _pcts([r["ttft_s"] for r in before if r["ok"] and r["ttft_s"] is not None]),
+            "ttft_ms_after": _pcts([r["ttft_s"] for r in after if r["ok"] and r["ttft_s"] is not None]),
+            "after_errors": sum(not r["ok"] for r in after),
+        }
+    return summary
+
+
+def print_summary(summary):
+    def row(label, pcts, unit="ms"):
+        vals = ["-" if pcts[k] is None else f"{pcts[k]:.1f}" for k in ("p50", "p90", "p99")]
+        print(f"  {label:22s} {vals[0]:>10s} {vals[1]:>10s} {vals[2]:>10s}  {unit}")
+
+    print("\n" + "=" * 70)
+    print("LOAD TEST SUMMARY")
+    print("=" * 70)
+    print(f"Requests: {summary['requests']}  ok: {summary['ok']}  error rate: {summary['error_rate']:.1%}")
+    for kind, count in summary["errors"].items():
+        print(f"  ✗ {kind}: {count}")
+    print(f"Wall: {summary['wall_s']:.1f}s  throughput: {summary['requests_per_s']:.2f} req/s, "
+          f"{summary['output_tokens_per_s']:.1f} output tok/s")
+    print(f"\n  {'':22s} {'p50':>10s} {'p90':>10s} {'p99':>10s}")
+    row("time to first token", summary["ttft_ms"])
+    row("inter-token latency", summary["itl_ms"])
+    row("end-to-end latency", summary["latency_ms"])
+    row("client queueing", summary["queue_ms"])
+    swap = summary.get("swap")
+    if swap:
+        print(f"\nAdapter switch: {swap['swap_ms']:.0f} ms on an idle server"
+              + (f" ✗ {swap['error']}" if swap["error"] else "")
+              + f" (drain {swap['drain_ms']:.0f} ms); TTFT over {swap['window']} requests each side"
+              + (f", {swap['after_errors']} failed after it" if swap["after_errors"] else ""))
+        row("TTFT before switch", swap["ttft_ms_before"])
+        row("TTFT after switch", swap["ttft_ms_after"])
+    print("=" * 70)
+
+
+# --- stub server -------------------------------------------------------------
+
+async def _stub_handler(reader, writer, error_rate, rng):
+    try:
+        request_line = await reader.readline()
+        method, path = request_line.decode().split()[:2]
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            if key.strip().lower() == "content-length":
+                length = int(value)
+        body = json.loads(await reader.readexactly(length)) if length else {}
+
+        def respond(status, payload):
+            data = json.dumps(payload).encode()
+            writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+
+        if method == "GET" and path == "/health":
+            respond(200, {"status": "ok"})
+        elif method == "POST" and path == LORA_PATH:
+            await asyncio.sleep(STUB_SWAP)
+            respond(200, {"success": True})
+        elif method == "POST" and path == CHAT_PATH:
+            if rng.random() < error_rate:
+                respond(503, {"error": {"message": "stub: injected failure"}})
+            else:
+                await _stub_stream(writer, body.get("max_tokens") or 16)
+        else:
+            respond(404, {"error": "not found"})
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _stub_stream(writer, tokens):
+    def chunk(event):
+        data = f"data: {event}\n\n".encode()
+        return f"{len(data):x}\r\n".encode() + data + b"\r\n"
+
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                 b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+    await asyncio.sleep(STUB_TTFT)
+    for i in range(tokens):
+        if i:
+            await asyncio.sleep(STUB_ITL)
+        event = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": f" tok{i}"}}]}
+        writer.write(chunk(json.dumps(event)))
+        await writer.drain()
+    writer.write(chunk("[DONE]") + b"0\r\n\r\n")
+
+
+async def start_stub(host="127.0.0.1", port=0, error_rate=0.0, seed=0):
+    """Start the fake OpenAI-compatible server; returns (server, url)."""
+    rng = random.Random(seed)
+    server = await asyncio.start_server(lambda r, w: _stub_handler(r, w, error_rate, rng), host, port)
+    port = server.sockets[0].getsockname()[1]
+    return server, f"http://{host}:{port}"
+
+
+# --- CLI ---------------------------------------------------------------------
+
+async def _main(args):
+    stub = None
+    url = args.url
+    if args.stub:
+        stub, url = await start_stub(error_rate=args.stub_error_rate)
+        print(f"Stub server on {url}")
+    prompts = load_prompts(args.prompts)
+    mode = f"open-loop {args.rate} req/s" if args.rate else "closed-loop"
+    print(f"Load test: {args.requests} requests, concurrency {args.concurrency}, {mode} -> {url}{CHAT_PATH}")
+    try:
+        results, swap, wall_s = await run_load(
+            url, prompts, args.requests, args.concurrency, args.rate, args.max_tokens, args.temp,
+            switch=args.switch_adapter, switch_after=args.switch_after, timeout=args.timeout,
+            switch_window=args.switch_window,
+        )
+    finally:
+        if stub:
+            stub.close()
+            await stub.wait_closed()
+    return results, swap, wall_s
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent streaming load test against /v1/chat/completions.")
+    parser.add_argument("--url", default=DEFAULT_URL, help="Server base URL (http only)")
+    parser.add_argument("--requests", type=int, default=64, help="Total requests to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="Max requests in flight")
+    parser.add_argument("--rate", type=float, help="Poisson arrival rate in requests/s (default: closed loop)")
+    parser.add_argument("--prompts", help="Prompt file (.jsonl with prompt/messages, or one prompt per line)")
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--temp", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="Per-request timeout in seconds")
+    parser.add_argument("--switch-adapter", nargs="+", metavar="PATH:SCALE",
+                        help="Switch adapters via /lora-adapters mid-run (PATH:SCALE or ID:SCALE, 'none' to clear)")
+    parser.add_argument("--switch-after", type=int, help="Completed requests before the switch (default: half)")
+    parser.add_argument("--switch-window", type=int, help="Requests each side of the switch compared for TTFT (default: --concurrency)")
+    parser.add_argument("--stub", action="store_true", help="Run against an in-process stub server (for testing)")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0, help="Fraction of stub requests answered with 503")
+    parser.add_argument("--out-dir", default=DEFAULT_OUT_DIR, help="Where to write the JSON report")
+    args = parser.parse_args(argv)
+
+    if args.requests < 1 or args.concurrency < 1:
+        print("Error: --requests and --concurrency must be at least 1")
+        return 1
+
+    results, swap, wall_s = asyncio.run(_main(args))
+    summary = summarize(results, swap, wall_s)
+    print_summary(summary)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    path = os.path.join(args.out_dir, f"load_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump({"url": "stub" if args.stub else args.url, "requests": args.requests,
+                   "concurrency": args.concurrency, "rate": args.rate, "max_tokens": args.max_tokens,
+                   "summary": summary, "results": results}, f, indent=2)
+    print(f"Wrote {path}")
+    return 0 if summary["ok"] == summary["requests"] and not (swap and swap["error"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,28 @@
 import argparse
 import os
 
-import torch
-from peft import PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
-
 BASE = "/workspace/models/hf_mistral"
 
 def merge_adapter(model, adapter_path):
+    from peft import PeftModel
+
     print(f"Merging adapter: {adapter_path}")
     model = PeftModel.from_pretrained(model, adapter_path)
     model = model.merge_and_unload()
     return model
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--adapter",
         default=None,
         help="Path to adapter folder (if none, merges all levels sequentially)",
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
 
     out_dir = "/workspace/peft/merged"
     os.makedirs(out_dir, exist_ok=True)
@@ -1,10 +1,13 @@
 import os, json
-from pypdf import PdfReader
+
+import archive_manifest
 
 RAW = "/workspace/data/raw_pdfs"
 OUT = "/workspace/data/processed/pdf_pretest.json"
 
 def pretest(path):
+    from pypdf import PdfReader
+
     reader = PdfReader(path)
     pages = reader.pages
     text = "\n".join(p.extract_text() or "" for p in pages)
@@ -29,11 +32,17 @@ def pretest(path):
 def main():
     os.makedirs(os.path.dirname(OUT), exist_ok=True)
     results = []
-    for f in os.listdir(RAW):
-        if f.lower().endswith(".pdf"):
-            info = pretest(os.path.join(RAW,f))
-            info["file"] = f
-            results.append(info)
+    # Hashing is cheap next to text extraction, so known documents are dropped first
+    manifest = archive_manifest.load_manifest()
+    fresh, duplicates = archive_manifest.scan(RAW, manifest, (".pdf",))
+    for f, sha, original in duplicates:
+        where = "already trained" if sha in manifest["objects"] else "in this upload"
+        print(f"Skipping {f}: same content as {original}, {where}")
+    for f, sha in fresh:
+        info = pretest(os.path.join(RAW,f))
+        info["file"] = f
+        info["sha256"] = sha
+        results.append(info)
     with open(OUT,"w") as f:
         json.dump(results,f,indent=2)
 
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+CPU smoke check for eval_layers.py --perplexity.
+
+Builds, in a temporary folder, a tiny randomly initialised Llama model with
+a word-level tokenizer, a freshly initialised LoRA adapter and a few
+held-out chunks, then runs the perplexity path on CPU. A new LoRA adapter
+has B = 0, so it must score exactly like the base model; the check also
+needs every chunk to be counted and every loss to be finite. No downloads
+or GPU are needed.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+import eval_layers
+
+HELDOUT_TEXTS = [
+    "current assets divided by current liabilities gives the current ratio",
+    "a lease liability is measured at the present value of lease payments",
+    "goodwill is tested for impairment at the reporting unit level",
+    "net interest income is interest earned minus interest paid",
+    "liquidity risk is the risk of not meeting cash obligations when due",
+    "revenue is recognized when control of goods transfers to the customer",
+]
+
+
+def build_fixture(root):
+    """Write the tiny base model, a zero LoRA adapter and heldout.jsonl under root."""
+    import torch
+    from peft import LoraConfig, get_peft_model
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    torch.manual_seed(0)
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for text in HELDOUT_TEXTS:
+        for word in text.split():
+            vocab.setdefault(word, len(vocab))
+    tok = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tok, unk_token="<unk>", bos_token="<s>", eos_token="</s>")
+
+    base = os.path.join(root, "base")
+    tokenizer.save_pretrained(base)
+    config = LlamaConfig(
+        vocab_size=len(vocab), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=128,
+        bos_token_id=1, eos_token_id=2,
+    )
+    LlamaForCausalLM(config).save_pretrained(base)
+
+    adapter = os.path.join(root, "zero_lora")
+    lora = LoraConfig(r=4, lora_alpha=8, target_modules=["q_proj", "v_proj"], task_type="CAUSAL_LM")
+    get_peft_model(LlamaForCausalLM.from_pretrained(base), lora).save_pretrained(adapter)
+
+    heldout = os.path.join(root, "heldout.jsonl")
+    with open(heldout, "w", encoding="utf-8") as f:
+        for text in HELDOUT_TEXTS:
+            f.write(json.dumps({"text": text}) + "\n")
+    return base, adapter, heldout
+
+
+def check(report):
+    """List of problems with a perplexity report of the fixture (empty when it passes)."""
+    problems = []
+    if report["chunks"] != len(HELDOUT_TEXTS):
+        problems.append(f"scored {report['chunks']} chunks, expected {len(HELDOUT_TEXTS)}")
+    scenarios = report["scenarios"]
+    for name in ("base", "zero_lora"):
+        r = scenarios.get(name)
+        if not r or r["loss"] is None or not math.isfinite(r["loss"]) or r["tokens"] <= 0:
+            problems.append(f"{name}: no finite loss ({r})")
+    if not problems and abs(scenarios["base"]["loss"] - scenarios["zero_lora"]["loss"]) > 1e-4:
+        problems.append(f"zero-initialised adapter changed the loss: "
+                        f"{scenarios['base']['loss']:.6f} vs {scenarios['zero_lora']['loss']:.6f}")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CPU smoke check of eval_layers.py --perplexity with a tiny model.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary fixture folder")
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix="ppl_smoke_")
+    try:
+        base, adapter, heldout = build_fixture(root)
+        out = os.path.join(root, "perplexity.json")
+        # A small budget so the chunks are split over several batches
+        rc = eval_layers.main([
+            "--perplexity", "--base", base, "--device", "cpu", "--adapters", adapter,
+            "--heldout", heldout, "--token-budget", "48", "--out", out,
+        ])
+        if rc:
+            print(f"✗ eval_layers --perplexity exited with {rc}")
+            return 1
+        with open(out) as f:
+            problems = check(json.load(f))
+    finally:
+        if args.keep:
+            print(f"Fixture kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    for p in problems:
+        print(f"✗ {p}")
+    if problems:
+        return 1
+    print("✓ Perplexity smoke check passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
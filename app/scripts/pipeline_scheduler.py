@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Runs independent pipeline stages concurrently.
+
+Each stage is one app/scripts script started in its own process, with an
+optional CPU-thread cap (exported through the usual *_NUM_THREADS variables)
+and an optional address-space cap in GB. A stage starts as soon as every
+stage named in its `after` list has finished successfully. Stages with the
+same `group` run one at a time (e.g. to share a CPU budget), but a failure
+in one does not skip the others.
+"""
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+_print_lock = threading.Lock()
+
+
+@dataclass
+class Stage:
+    name: str
+    script: str
+    argv: list = field(default_factory=list)
+    after: list = field(default_factory=list)
+    threads: int = None
+    mem_gb: float = None
+    group: str = None
+
+
+def _log(stage_name, line):
+    with _print_lock:
+        print(f"[{stage_name}] {line}", end="" if line.endswith("\n") else "\n", flush=True)
+
+
+def run_stage(stage, profile=None):
+    """Run one stage to completion, prefixing its output with the stage name.
+
+    With a stage_profiler.RunProfile the child's resource usage is recorded too.
+    """
+    env = os.environ.copy()
+    env["PYTHONUNBUFFERED"] = "1"
+    if stage.threads:
+        for var in THREAD_ENV_VARS:
+            env[var] = str(stage.threads)
+
+    cmd = [sys.executable, os.path.join(SCRIPTS_DIR, f"{stage.script}.py")] + list(stage.argv)
+    if stage.mem_gb:
+        # Re-exec through this module so the limit is in place before the stage starts;
+        # preexec_fn would do the same but is unsafe with the worker threads
+        cmd = [sys.executable, os.path.abspath(__file__), "--limit-as", str(int(stage.mem_gb * 1024 ** 3)), "--"] + cmd
+    limits = []
+    if stage.threads:
+        limits.append(f"{stage.threads} threads")
+    if stage.mem_gb:
+        limits.append(f"{stage.mem_gb:g} GB")
+    _log(stage.name, f"started ({', '.join(limits) or 'no limits'})")
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        text=True, bufsize=1,
+    )
+    sampler = profile.sampler(proc.pid) if profile else None
+
+    for line in proc.stdout:
+        _log(stage.name, line)
+    if profile:
+        # Wait for the exit without reaping, so /proc/<pid>/io still holds the final counters
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        sampler.stop()
+        # wait4 reaps the child and returns its own rusage (CPU time, max RSS)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = rc = os.waitstatus_to_exitcode(status)
+    else:
+        rc = proc.wait()
+    elapsed = time.perf_counter() - start
+    if profile:
+        profile.record_process(stage.name, elapsed, usage, sampler, rc == 0)
+
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, cmd)
+    _log(stage.name, f"finished in {elapsed:.1f}s")
+    return elapsed
+
+
+def run_stages(stages, max_workers=None, profile=None):
+    """
+    Run stages respecting their `after` dependencies and return {name: seconds}.
+
+    Stages must be listed in dependency order. Raises RuntimeError after all
+    runnable stages have finished if any stage failed.
+    """
+    seen = set()
+    for stage in stages:
+        missing = [dep for dep in stage.after if dep not in seen]
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on {missing}, which must be listed before it")
+        seen.add(stage.name)
+
+    futures = {}
+    locks = {stage.group: threading.Lock() for stage in stages if stage.group}
+    start = time.perf_counter()
+
+    # Dependencies are always submitted before their dependents, so a worker
+    # blocked on a dependency never waits for a task queued behind it.
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages)) as pool:
+        for stage in stages:
+            deps = [(dep, futures[dep]) for dep in stage.after]
+
+            def task(stage=stage, deps=deps):
+                for dep_name, dep in deps:
+                    if dep.exception() is not None:
+                        raise RuntimeError(f"skipped, {dep_name} failed")
+                if stage.group:
+                    with locks[stage.group]:
+                        return run_stage(stage, profile)
+                return run_stage(stage, profile)
+
+            futures[stage.name] = pool.submit(task)
+
+    total = time.perf_counter() - start
+    timings, failed = {}, []
+
+    print("\n" + "=" * 60)
+    print("STAGE TIMINGS")
+    print("=" * 60)
+    for stage in stages:
+        exc = futures[stage.name].exception()
+        if exc is None:
+            timings[stage.name] = futures[stage.name].result()
+            print(f"  ✓ {stage.name:24s} {timings[stage.name]:8.1f}s")
+        else:
+            failed.append(stage.name)
+            print(f"  ✗ {stage.name:24s} {exc}")
+    print(f"  {'wall time':26s} {total:8.1f}s")
+    print("=" * 60)
+
+    if failed:
+        raise RuntimeError(f"Stages failed: {', '.join(failed)}")
+    return timings
+
+
+def _exec_limited(argv):
+    """--limit-as BYTES -- CMD...: set RLIMIT_AS, then exec CMD (the limit survives exec)."""
+    limit = int(argv[1])
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    cmd = argv[3:]
+    os.execv(cmd[0], cmd)
+
+
+if __name__ == "__main__":
+    _exec_limited(sys.argv[1:])
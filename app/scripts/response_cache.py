@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Persistent cache of deterministic model responses.
+
+Entries are keyed by the content hash of the model, the content hashes and
+scales of the active adapters, the prompt, the sampling parameters and the
+seed, so re-running a prompt suite against unchanged artifacts returns the
+stored output instead of generating again. Only deterministic settings are
+cached (temperature 0, or a fixed seed); anything else always misses.
+
+Storage is a single SQLite file with least-recently-used eviction by entry
+count and total size. GGUF hashes come from the GGUF catalog; other files
+and directories (HF models, PEFT adapter folders) are hashed once per
+size/mtime version and remembered here.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import gguf_catalog
+
+CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "/workspace/cache/responses.sqlite")
+MAX_ENTRIES = 20000
+MAX_BYTES = 512 * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+"""
+
+
+def is_deterministic(temp, seed=None):
+    """Greedy decoding, or sampling with a fixed seed."""
+    return (temp is not None and float(temp) == 0.0) or (seed is not None and int(seed) >= 0)
+
+
+class ResponseCache:
+    """LRU response store; counts hits and misses for the current session."""
+
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _file_hash(self, path):
+        st = os.stat(path)
+        row = self.db.execute(
+            "SELECT sha256 FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, st.st_size, st.st_mtime_ns),
+        ).fetchone()
+        if row:
+            return row[0]
+        if path.endswith(".gguf"):
+            digest = gguf_catalog.refresh([path], with_hash=True)[0]["sha256"]
+        else:
+            digest = gguf_catalog.file_sha256(path)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                            (path, st.st_size, st.st_mtime_ns, digest))
+        return digest
+
+    def content_hash(self, path):
+        """sha256 of a file, or of every file (relative path + hash) under a directory."""
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            return self._file_hash(path)
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                digest.update(f"{os.path.relpath(full, path)}\0{self._file_hash(full)}\n".encode())
+        return digest.hexdigest()
+
+    def key(self, model, adapters, prompt, params, seed=None):
+        """
+        Cache key for one generation, or None when the settings are not deterministic.
+
+        adapters is [(path, scale), ...]; params holds every sampling/decoding
+        setting that affects the output (must include "temp").
+        """
+        if not is_deterministic(params.get("temp"), seed):
+            return None
+        record = {
+            "model": self.content_hash(model),
+            "adapters": sorted((self.content_hash(p), float(s)) for p, s in adapters if s),
+            "prompt": prompt,
+            "params": params,
+            "seed": seed,
+        }
+        return hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        if key is None:
+            return None
+        row = self.db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.db:
+            self.db.execute("UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        if key is None:
+            return
+        data = json.dumps(value)
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, bytes, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now),
+            )
+            self._evict()
+
+    def _evict(self):
+        count, total = self.db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        # Drop least recently used entries until both limits hold
+        dropped = []
+        for key, size in self.db.execute("SELECT key, bytes FROM responses ORDER BY last_used"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            dropped.append((key,))
+            count -= 1
+            total -= size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", dropped)
+
+    def stats(self):
+        count, total, hits = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(hits), 0) FROM responses"
+        ).fetchone()
+        return {"entries": count, "bytes": total, "lifetime_hits": hits,
+                "session_hits": self.hits, "session_misses": self.misses}
+
+    def report(self):
+        s = self.stats()
+        lookups = self.hits + self.misses
+        rate = f"{self.hits / lookups:.0%}" if lookups else "-"
+        print(f"Response cache: {self.hits}/{lookups} hits ({rate}), "
+              f"{s['entries']} entries, {s['bytes'] / 1e6:.1f} MB ({self.path})")
+
+    def clear(self):
+        with self.db:
+            self.db.execute("DELETE FROM responses")
+            self.db.execute("DELETE FROM file_hashes")
+        self.db.execute("VACUUM")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or clear the deterministic response cache.")
+    parser.add_argument("action", choices=["stats", "clear"])
+    parser.add_argument("--path", default=CACHE_PATH, help="SQLite cache file")
+    args = parser.parse_args(argv)
+
+    with ResponseCache(args.path) as cache:
+        if args.action == "clear":
+            cache.clear()
+            print(f"Cleared {args.path}")
+        else:
+            s = cache.stats()
+            print(f"{args.path}: {s['entries']} entries, {s['bytes'] / 1e6:.1f} MB, {s['lifetime_hits']} lifetime hits")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,34 @@
+"""
+Small helpers shared by the benchmark, load-test and adapter scripts.
+
+Standard library only, so importing it does not pull in the model,
+server or export tooling of the scripts that use it.
+"""
+import math
+
+DEFAULT_OUT_DIR = "/workspace/bench"
+
+BENCH_PROMPTS = [
+    "Explain the importance of liquidity risk management in banking.",
+    "Summarize the key differences between operating and finance leases under ASC 842.",
+    "A company has current assets of $500,000 and current liabilities of $320,000. Compute and interpret its current ratio.",
+    "List three indicators that a long-lived asset may be impaired.",
+]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def parse_weighted(spec):
+    """'path:0.6' -> (path, 0.6); a bare path gets weight 1.0."""
+    path, sep, weight = spec.rpartition(":")
+    if not sep:
+        return spec, 1.0
+    try:
+        return path, float(weight)
+    except ValueError:
+        return spec, 1.0
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Speculative decoding runs with llama.cpp's draft-model support.
+
+A small draft GGUF (same tokenizer as the target) proposes up to
+--draft-max tokens that the target model verifies in one batch. Each run
+is paired with a plain llama-cli baseline on the same prompt, model and
+thread count, both greedy, and the acceptance rate and decode tokens/sec
+of the two are reported side by side.
+
+llama-speculative loads the target and the draft with the same parameters,
+so --lora would also be applied to the draft, and fail on the shape
+mismatch. An adapter is therefore merged into the target first with
+llama-export-lora and re-quantized to the base model's type with
+llama-quantize, so the numbers are those of a model the size of the one
+served. Both the baseline and the speculative run use that merged GGUF.
+Merges are cached under MERGED_DIR, which keeps the MERGED_KEEP most
+recently used ones.
+"""
+import glob
+import hashlib
+import os
+import re
+import shlex
+import subprocess
+
+import bench_gguf
+import gguf_catalog
+from convert_to_gguf import QUANT_BIN
+from export_lora import EXPORT_BIN
+
+SPECULATIVE_BINARIES = [
+    "/workspace/llama.cpp/build/bin/llama-speculative",
+    "/workspace/llama.cpp/build/bin/speculative",
+    "/workspace/llama.cpp/llama-speculative",
+]
+DEFAULT_DRAFT_MAX = 16
+MERGED_DIR = "/workspace/cache/merged"
+MERGED_KEEP = 2
+# llama_ftype values left as llama-export-lora writes them: ALL_F32, MOSTLY_F16, MOSTLY_BF16
+UNQUANTIZED_FTYPES = (0, 1, 32)
+
+# llama-speculative end-of-run statistics, e.g.
+#   decoded  100 tokens in    2.345 seconds, speed:   42.6 t/s
+#   n_drafted = 120
+#   n_accept  = 80
+#   accept    = 66.667%
+_DECODED_RE = re.compile(r"decoded\s+(\d+) tokens in\s+([\d.]+) seconds, speed:\s+([\d.]+) t/s")
+_STAT_RE = re.compile(r"\b(n_drafted|n_accept|accept)\s*=\s*([\d.]+)")
+
+
+def find_speculative_binary():
+    for p in SPECULATIVE_BINARIES:
+        if os.path.exists(p):
+            return p
+    return None
+
+
+def parse_speculative(text):
+    """Extract decoded tokens/speed and draft statistics from llama-speculative output."""
+    out = {}
+    m = _DECODED_RE.search(text)
+    if m:
+        out.update(decoded_tokens=int(m.group(1)), decode_s=float(m.group(2)), decode_tps=float(m.group(3)))
+    for key, value in _STAT_RE.findall(text):
+        out[key] = float(value) if key == "accept" else int(value)
+    if "accept" not in out and out.get("n_drafted"):
+        out["accept"] = 100.0 * out.get("n_accept", 0) / out["n_drafted"]
+    return out
+
+
+def file_type(path):
+    """general.file_type (llama_ftype) of a GGUF model, or None."""
+    return gguf_catalog.refresh([path])[0].get("file_type")
+
+
+def _run_tool(cmd, output, what):
+    print(f"{what}: {' '.join(shlex.quote(c) for c in cmd)}")
+    proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if proc.returncode != 0 or not os.path.exists(output):
+        tail = "\n".join(proc.stdout.strip().splitlines()[-5:])
+        raise RuntimeError(f"{os.path.basename(cmd[0])} failed (rc={proc.returncode}):\n{tail}")
+
+
+def _prune(merged_dir, keep=MERGED_KEEP):
+    """Drop all but the `keep` most recently used merges."""
+    merges = sorted(glob.glob(os.path.join(merged_dir, "*.gguf")), key=os.path.getmtime, reverse=True)
+    for path in merges[keep:]:
+        print(f"Removing cached merge {os.path.basename(path)}")
+        os.remove(path)
+
+
+def merged_model(model, adapter, threads=None, merged_dir=MERGED_DIR):
+    """Target GGUF with the adapter merged in at the base model's type, reused while newer than both inputs."""
+    stem = lambda p: os.path.splitext(os.path.basename(p))[0]
+    # Full paths in the key, so same-named files in different folders do not collide
+    key = hashlib.sha1(f"{os.path.abspath(model)}\0{os.path.abspath(adapter)}".encode()).hexdigest()[:10]
+    out = os.path.join(merged_dir, f"{stem(model)}+{stem(adapter)}-{key}.gguf")
+    if os.path.exists(out) and os.path.getmtime(out) >= max(os.path.getmtime(model), os.path.getmtime(adapter)):
+        os.utime(out)  # most recently used, for _prune
+        return out
+    if not os.path.exists(EXPORT_BIN):
+        raise RuntimeError(f"{EXPORT_BIN} not found; it is needed to apply an adapter to the target only")
+
+    os.makedirs(merged_dir, exist_ok=True)
+    merged = f"{out}.f16.tmp.{os.getpid()}"
+    quantized = f"{out}.tmp.{os.getpid()}"
+    try:
+        cmd = [EXPORT_BIN, "-m", model, "--lora", adapter, "-o", merged]
+        if threads:
+            cmd += ["-t", str(threads)]
+        _run_tool(cmd, merged, "Merging adapter into target")
+        ftype = file_type(model)
+        if ftype is None or ftype in UNQUANTIZED_FTYPES:
+            os.replace(merged, out)
+        elif os.path.exists(QUANT_BIN):
+            # llama-export-lora writes merged tensors as F16/F32; match the served model's size
+            cmd = [QUANT_BIN, merged, quantized, str(ftype)]
+            if threads:
+                cmd.append(str(threads))
+            _run_tool(cmd, quantized, "Re-quantizing to the base model's type")
+            os.replace(quantized, out)
+        else:
+            print(f"⚠ {QUANT_BIN} not found; the merged target stays unquantized")
+            os.replace(merged, out)
+    finally:
+        for path in (merged, quantized):
+            if os.path.exists(path):
+                os.remove(path)
+    _prune(merged_dir)
+    return out
+
+
+def run_speculative(binary, model, draft_model, prompt, max_tokens, draft_max=DEFAULT_DRAFT_MAX,
+                    ngl=0, threads=None):
+    """One greedy llama-speculative run (no adapter: merge it into the model first)."""
+    cmd = [
+        binary, "-m", model, "-md", draft_model, "-p", prompt,
+        "-n", str(max_tokens), "--draft-max", str(draft_max),
+        "--temp", "0", "--seed", "42",
+    ]
+    if threads:
+        cmd += ["-t", str(threads)]
+    if ngl and ngl > 0:
+        cmd += ["-ngl", str(ngl), "-ngld", str(ngl)]
+
+    print(f"Command: {' '.join(shlex.quote(c) for c in cmd)}")
+    proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    result = parse_speculative(proc.stdout + "\n" + proc.stderr)
+    result.update(
+        ok=proc.returncode == 0 and bool(proc.stdout.strip()) and result.get("decoded_tokens", 0) > 0,
+        returncode=proc.returncode,
+        content=proc.stdout,
+    )
+    if not result["ok"]:
+        result["error"] = "\n".join(proc.stderr.strip().splitlines()[-5:])
+    return result
+
+
+def compare(cli_binary, spec_binary, model, draft_model, adapters, prompt, max_tokens=256,
+            draft_max=DEFAULT_DRAFT_MAX, ngl=0, threads=None, ctx=4096):
+    """Baseline vs. speculative for the base model (None) and/or each adapter; returns result rows."""
+    threads = threads or os.cpu_count() or 4
+    rows = []
+    for adapter in adapters:
+        label = os.path.basename(adapter) + " (merged)" if adapter else "(base)"
+        print("\n" + "=" * 70)
+        print(f"Speculative decoding: {label} (draft {os.path.basename(draft_model)}, draft-max {draft_max})")
+        print("=" * 70)
+
+        try:
+            target = merged_model(model, adapter, threads) if adapter else model
+        except RuntimeError as e:
+            print(f"✗ {e}")
+            rows.append({"adapter": label, "ok": False, "baseline_tps": None, "speculative_tps": None,
+                         "speedup": None, "accept_pct": None, "n_drafted": None, "n_accept": None})
+            continue
+        if adapter and file_type(target) != file_type(model):
+            label = os.path.basename(adapter) + " (unquantized)"
+            print("⚠ The merged target is larger than the served model, so speedup and acceptance are not representative")
+        base = bench_gguf.run_once(cli_binary, target, None, prompt, threads, ngl, ctx, max_tokens)
+        spec = run_speculative(spec_binary, target, draft_model, prompt, max_tokens, draft_max, ngl, threads)
+        if spec["ok"]:
+            print(spec["content"])
+        else:
+            print(f"✗ llama-speculative failed (rc={spec['returncode']}):\n{spec.get('error', '')}")
+
+        speedup = None
+        if base["ok"] and spec["ok"] and base.get("eval_tps"):
+            speedup = spec["decode_tps"] / base["eval_tps"]
+        rows.append({
+            "adapter": label,
+            "ok": base["ok"] and spec["ok"],
+            "baseline_tps": base.get("eval_tps") if base["ok"] else None,
+            "speculative_tps": spec.get("decode_tps") if spec["ok"] else None,
+            "speedup": speedup,
+            "accept_pct": spec.get("accept"),
+            "n_drafted": spec.get("n_drafted"),
+            "n_accept": spec.get("n_accept"),
+        })
+    print_comparison(rows)
+    return rows
+
+
+def print_comparison(rows):
+    print("\n" + "=" * 70)
+    print("SPECULATIVE DECODING vs BASELINE (generation tokens/sec)")
+    print("=" * 70)
+    print(f"  {'adapter':28s} {'baseline':>9s} {'spec':>9s} {'speedup':>8s} {'accept':>8s} {'drafted':>8s}")
+
+    def fmt(value, spec, suffix=""):
+        return "-" if value is None else format(value, spec) + suffix
+
+    for r in rows:
+        mark = "✓" if r["ok"] else "✗"
+        print(f"{mark} {r['adapter'][:28]:28s} {fmt(r['baseline_tps'], '.1f'):>9s} {fmt(r['speculative_tps'], '.1f'):>9s} "
+              f"{fmt(r['speedup'], '.2f', 'x'):>8s} {fmt(r['accept_pct'], '.1f', '%'):>8s} {fmt(r['n_drafted'], 'd'):>8s}")
+    print("=" * 70)
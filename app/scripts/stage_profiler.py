@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Per-stage resource profile of a main.py run.
+
+For every stage it records wall and CPU time, peak RSS, bytes read from
+and written to disk, and peak GPU memory when a GPU is present. In-process
+stages are measured on this process and its children: rusage deltas, VmHWM
+reset through /proc/self/clear_refs, /proc/self/io deltas, and a sampler
+summing RSS over the process tree. Stages run by the pipeline scheduler are
+measured per child process (wait4 CPU time plus the same sampler). GPU memory
+is the torch allocator peak for in-process stages and device memory in use
+sampled with nvidia-smi.
+
+Each run writes a JSON report under /workspace/profiles and prints a
+summary compared with the previous report of the same mode.
+"""
+import glob
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/workspace/profiles")
+SAMPLE_INTERVAL = 0.5
+# nvidia-smi is slow to start, so it is sampled less often than /proc
+GPU_SAMPLE_EVERY = 4
+# Changes smaller than these are never flagged as regressions
+REGRESSION_PCT = 10
+MIN_WALL_DELTA_S = 1.0
+MIN_RSS_DELTA_MB = 50
+
+
+def _read_io(pid="self"):
+    """read_bytes/write_bytes (actual block I/O) from /proc/<pid>/io, or None."""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["read_bytes"]), int(fields["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _rss_kb(pid, field="VmRSS"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid):
+    out = []
+    for task in glob.glob(f"/proc/{pid}/task/*/children"):
+        try:
+            with open(task) as f:
+                out += [int(c) for c in f.read().split()]
+        except OSError:
+            pass
+    return out
+
+
+def _tree(pid):
+    pids, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        pids.append(p)
+        todo += _children(p)
+    return pids
+
+
+def _gpu_used_mb():
+    try:
+        out = subprocess.run(
+            ["nvidia-smi", "--query-gpu=memory.used", "--format=csv,noheader,nounits"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=10,
+        ).stdout
+        return sum(float(v) for v in out.split())
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+
+def _reset_hwm():
+    """Reset this process's VmHWM so it reflects only the coming stage (Linux >= 4.0)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _torch_cuda():
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch
+    return None
+
+
+class TreeSampler(threading.Thread):
+    """Samples RSS summed over a process tree, the root's I/O counters and GPU memory in use."""
+
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_kb = 0
+        self.last_io = None
+        self.gpu_peak_mb = None
+        self.use_gpu = shutil.which("nvidia-smi") is not None
+        self._done = threading.Event()
+
+    def sample(self, n):
+        self.peak_rss_kb = max(self.peak_rss_kb, sum(_rss_kb(p) for p in _tree(self.pid)))
+        self.last_io = _read_io(self.pid) or self.last_io
+        if self.use_gpu and n % GPU_SAMPLE_EVERY == 0:
+            used = _gpu_used_mb()
+            if used is not None:
+                self.gpu_peak_mb = max(self.gpu_peak_mb or 0, used)
+
+    def run(self):
+        n = 0
+        while not self._done.is_set():
+            self.sample(n)
+            n += 1
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        # Writes after the last periodic sample would otherwise be missed
+        self.last_io = _read_io(self.pid) or self.last_io
+
+
+class RunProfile:
+    """Collects stage records for one main.py invocation and writes the report."""
+
+    def __init__(self, mode, argv, out_dir=PROFILE_DIR):
+        self.mode = mode
+        self.argv = list(argv)
+        self.out_dir = out_dir
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def _add(self, record):
+        with self._lock:
+            self.stages.append(record)
+        print(f"[profile] {record['stage']}: {record['wall_s']:.1f}s wall, {record['cpu_s']:.1f}s CPU, "
+              f"peak RSS {record['peak_rss_mb']:.0f} MB, "
+              f"read {record['read_mb']:.0f} MB / wrote {record['write_mb']:.0f} MB")
+
+    @contextmanager
+    def stage(self, name):
+        """Profile a stage that runs in this process (including any children it waits for)."""
+        torch = _torch_cuda()
+        if torch:
+            torch.cuda.reset_peak_memory_stats()
+        hwm_reset = _reset_hwm()
+        io0 = _read_io()
+        self0 = resource.getrusage(resource.RUSAGE_SELF)
+        kids0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        sampler = TreeSampler(os.getpid())
+        sampler.start()
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            wall = time.perf_counter() - start
+            sampler.stop()
+            self1 = resource.getrusage(resource.RUSAGE_SELF)
+            kids1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            io1 = _read_io()
+            peak_kb = max(sampler.peak_rss_kb, _rss_kb("self", "VmHWM") if hwm_reset else 0)
+            # torch may have been imported (and CUDA initialized) by the stage itself
+            torch = _torch_cuda()
+            gpu = [v for v in (sampler.gpu_peak_mb,
+                               torch.cuda.max_memory_allocated() / 2 ** 20 if torch else None) if v is not None]
+            self._add({
+                "stage": name,
+                "ok": ok,
+                "wall_s": round(wall, 3),
+                "cpu_user_s": round(self1.ru_utime - self0.ru_utime + kids1.ru_utime - kids0.ru_utime, 3),
+                "cpu_sys_s": round(self1.ru_stime - self0.ru_stime + kids1.ru_stime - kids0.ru_stime, 3),
+                "cpu_s": round(sum(getattr(b, f) - getattr(a, f)
+                                   for a, b in ((self0, self1), (kids0, kids1))
+                                   for f in ("ru_utime", "ru_stime")), 3),
+                "peak_rss_mb": round(peak_kb / 1024, 1),
+                "read_mb": round((io1[0] - io0[0]) / 2 ** 20, 1) if io0 and io1 else 0.0,
+                "write_mb": round((io1[1] - io0[1]) / 2 ** 20, 1) if io0 and io1 else 0.0,
+                "gpu_peak_mb": round(max(gpu), 1) if gpu else None,
+            })
+
+    def sampler(self, pid):
+        """Start a sampler for a child process that will be recorded with record_process()."""
+        sampler = TreeSampler(pid)
+        sampler.start()
+        return sampler
+
+    def record_process(self, name, wall, usage, sampler, ok):
+        """Record a child stage from its wait4() rusage and the sampler that watched it.
+
+        Stop the sampler before reaping the child to include its final I/O.
+        """
+        sampler.stop()
+        io = sampler.last_io
+        # ru_maxrss carries the parent's high-water mark across fork+exec, so
+        # the sampled tree peak is used whenever there is one
+        peak_kb = sampler.peak_rss_kb or usage.ru_maxrss
+        self._add({
+            "stage": name,
+            "ok": ok,
+            "wall_s": round(wall, 3),
+            "cpu_user_s": round(usage.ru_utime, 3),
+            "cpu_sys_s": round(usage.ru_stime, 3),
+            "cpu_s": round(usage.ru_utime + usage.ru_stime, 3),
+            "peak_rss_mb": round(peak_kb / 1024, 1),
+            "read_mb": round(io[0] / 2 ** 20, 1) if io else 0.0,
+            "write_mb": round(io[1] / 2 ** 20, 1) if io else 0.0,
+            "gpu_peak_mb": sampler.gpu_peak_mb,
+        })
+
+    def previous_report(self):
+        """Most recent earlier report for the same mode, or None."""
+        for path in sorted(glob.glob(os.path.join(self.out_dir, "profile_*.json")), reverse=True):
+            try:
+                with open(path) as f:
+                    report = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if report.get("mode") == self.mode:
+                return path, report
+        return None
+
+    def finish(self):
+        """Write the JSON report and print the summary (with deltas vs. the previous run)."""
+        if not self.stages:
+            return None
+        previous = self.previous_report()
+        report = {
+            "mode": self.mode,
+            "argv": self.argv,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "cpus": os.cpu_count(),
+            "total_wall_s": round(time.perf_counter() - self.start, 3),
+            "stages": self.stages,
+        }
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, f"profile_{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))}.json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print_summary(report, previous[1] if previous else None)
+        if previous:
+            print(f"Compared with {previous[0]}")
+        print(f"Profile written to {path}")
+        return path
+
+
+def _delta(new, old, min_abs):
+    """'+12%' style change, with a flag when it is a meaningful regression."""
+    if old is None or new is None or old == 0:
+        return "", False
+    pct = (new - old) / old * 100
+    return f"{pct:+.0f}%", pct > REGRESSION_PCT and new - old > min_abs
+
+
+def print_summary(report, previous=None):
+    before = {s["stage"]: s for s in (previous or {}).get("stages", [])}
+    print("\n" + "=" * 110)
+    print(f"STAGE PROFILE ({report['mode']})")
+    print("=" * 110)
+    print(f"  {'stage':36s} {'wall s':>9s} {'Δ':>6s} {'CPU s':>9s} {'RSS MB':>9s} {'Δ':>6s} "
+          f"{'read MB':>9s} {'write MB':>9s} {'GPU MB':>8s}")
+    regressions = []
+    for s in report["stages"]:
+        old = before.get(s["stage"], {})
+        wall_delta, wall_bad = _delta(s["wall_s"], old.get("wall_s"), MIN_WALL_DELTA_S)
+        rss_delta, rss_bad = _delta(s["peak_rss_mb"], old.get("peak_rss_mb"), MIN_RSS_DELTA_MB)
+        if wall_bad or rss_bad:
+            regressions.append(s["stage"])
+        mark = "✗" if not s["ok"] else "⚠" if wall_bad or rss_bad else "✓"
+        gpu = "-" if s["gpu_peak_mb"] is None else f"{s['gpu_peak_mb']:.0f}"
+        print(f"{mark} {s['stage'][:36]:36s} {s['wall_s']:9.1f} {wall_delta:>6s} {s['cpu_s']:9.1f} "
+              f"{s['peak_rss_mb']:9.0f} {rss_delta:>6s} {s['read_mb']:9.0f} {s['write_mb']:9.0f} {gpu:>8s}")
+    print(f"  {'total wall time':36s} {report['total_wall_s']:9.1f}")
+    if regressions:
+        print(f"⚠ Slower or larger than the previous run (>{REGRESSION_PCT}%): {', '.join(regressions)}")
+    print("=" * 110)
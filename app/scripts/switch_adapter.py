@@ -5,28 +5,45 @@ Provides an easy way to test base model and switch between adapters.
 """
 import argparse
 import os
-import subprocess
 import sys
+import time
+import urllib.error
+
+import bench_gguf
+import gguf_catalog
+import llama_server
+import test_gguf
+from script_helpers import parse_weighted
 
 DEFAULT_BASE_MODEL = "/workspace/models/mistral-7b-instruct-v0.2.Q4_K_M.gguf"
 DEFAULT_ADAPTERS_DIR = "/workspace/output/adapters_gguf/v3"
 DEFAULT_PROMPT = "Explain the importance of liquidity risk management in banking."
 
+REPL_HELP = """Type a prompt and press Enter. Commands:
+  :adapter NAME [SCALE]       use one adapter (default scale 1.0)
+  :blend NAME:W NAME:W ...    apply several adapters at the given scales
+  :base                       no adapter
+  :list                       show adapters and the active scales
+  :temp X  /  :max N          sampling temperature / max tokens
+  :help  /  :quit"""
+
 def list_adapters(adapters_dir):
-    """List all .gguf adapters in the directory."""
-    if not os.path.isdir(adapters_dir):
-        return []
-    
+    """List all valid .gguf adapters in the directory (headers checked via the GGUF catalog)."""
     adapters = []
-    for name in sorted(os.listdir(adapters_dir)):
-        if name.lower().endswith(".gguf"):
-            adapters.append((name, os.path.join(adapters_dir, name)))
+    for entry in gguf_catalog.scan_dir(adapters_dir):
+        if not entry["valid"]:
+            print(f"⚠ Skipping {entry['name']}: {entry['error']}")
+            continue
+        adapters.append((entry["name"], entry["path"]))
     
     return adapters
 
-def run_test(model, adapter=None, prompt=DEFAULT_PROMPT, max_tokens=256, temp=0.7, ngl=None):
-    """Run a single test with the given model and optional adapter."""
-    cmd = ["python3", "/app/scripts/test_gguf.py", model]
+def run_test(model, adapter=None, prompt=DEFAULT_PROMPT, max_tokens=256, temp=0.7, ngl=None, backend="cli",
+             draft_model=None, draft_max=16):
+    """Run a single test with the given model and optional adapter (speculative vs. plain with a draft model)."""
+    cmd = [model, "--backend", backend]
+    if draft_model:
+        cmd.extend(["--draft-model", draft_model, "--draft-max", str(draft_max)])
     
     if adapter:
         cmd.extend(["--adapter", adapter])
@@ -44,15 +61,177 @@ def run_test(model, adapter=None, prompt=DEFAULT_PROMPT, max_tokens=256, temp=0.
     print(f"Testing: {'Base model only' if not adapter else os.path.basename(adapter)}")
     print("=" * 70)
     
-    try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"\n✗ Test failed: {e}")
+    # test_gguf runs in this process; only llama-cli itself is a child process
+    if test_gguf.main(cmd) != 0:
+        print("\n✗ Test failed")
         return False
     
     return True
 
-def interactive_menu(base_model, adapters_dir, prompt, max_tokens, temp, ngl):
+def run_all(model, adapters_dir, prompt=DEFAULT_PROMPT, max_tokens=256, temp=0.7, ngl=None, backend="cli",
+            draft_model=None, draft_max=16):
+    """Test every adapter; the server backend loads the base model once for the whole sweep."""
+    adapters = list_adapters(adapters_dir)
+    if draft_model:
+        print(f"\nComparing speculative and plain decoding for all {len(adapters)} adapters...\n")
+        cmd = [model, "--adapters-dir", adapters_dir, "--draft-model", draft_model, "--draft-max", str(draft_max),
+               "--prompt", prompt, "--max-tokens", str(max_tokens)]
+        if ngl is not None:
+            cmd.extend(["--ngl", str(ngl)])
+        return test_gguf.main(cmd) == 0
+    if backend == "server":
+        print(f"\nTesting all {len(adapters)} adapters on one llama-server...\n")
+        cmd = [model, "--backend", "server", "--adapters-dir", adapters_dir,
+               "--prompt", prompt, "--max-tokens", str(max_tokens), "--temp", str(temp)]
+        if ngl is not None:
+            cmd.extend(["--ngl", str(ngl)])
+        return test_gguf.main(cmd) == 0
+
+    print(f"\nTesting all {len(adapters)} adapters sequentially...\n")
+    success = True
+    for name, path in adapters:
+        if not run_test(model, path, prompt, max_tokens, temp, ngl):
+            success = False
+    return success
+
+def run_auto(model, adapters_dir, prompt=DEFAULT_PROMPT, max_tokens=256, temp=0.7, ngl=None, backend="cli", top_k=1):
+    """Run only the adapter(s) the BM25 router picks for the prompt."""
+    cmd = [model, "--backend", backend, "--adapters-dir", adapters_dir, "--auto", "--top-k", str(top_k),
+           "--prompt", prompt, "--max-tokens", str(max_tokens), "--temp", str(temp)]
+    if ngl is not None:
+        cmd.extend(["--ngl", str(ngl)])
+    return test_gguf.main(cmd) == 0
+
+def run_bench(model, adapters, include_base=True, ngl=None, threads=None, ctx="2048", repeats=3, max_tokens=64):
+    """Benchmark the base model and/or the given adapter paths (CPU-only unless ngl is set)."""
+    cmd = ["--models", model, "--ngl", str(ngl or 0), "--ctx", ctx,
+           "--repeats", str(repeats), "--max-tokens", str(max_tokens)]
+    if threads:
+        cmd += ["--threads", threads]
+    if adapters:
+        cmd += ["--adapters"] + list(adapters)
+    if not include_base:
+        cmd.append("--no-base")
+    return bench_gguf.main(cmd) == 0
+
+def stream_prompt(server, prompt, max_tokens, temp):
+    """Stream one completion to the terminal and print latency and tokens/sec inline."""
+    start = time.perf_counter()
+    first = None
+    pieces, timings = [], {}
+    try:
+        for event in server.stream(prompt, max_tokens=max_tokens, temp=temp):
+            piece = event.get("content", "")
+            if piece:
+                first = first or time.perf_counter()
+                pieces.append(piece)
+                print(piece, end="", flush=True)
+            if event.get("stop"):
+                timings = event.get("timings", {})
+    except KeyboardInterrupt:
+        print("\n(interrupted)")
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        print(f"\n✗ Request failed: {e}")
+        return
+    total = time.perf_counter() - start
+
+    if not "".join(pieces).strip():
+        print("✗ Empty output")
+    tokens = timings.get("predicted_n", len(pieces))
+    tps = timings.get("predicted_per_second")
+    if tps is None and first and total > first - start:
+        tps = tokens / (total - (first - start))
+    ttft = f"{(first - start) * 1000:.0f} ms" if first else "-"
+    print(f"\n  [first token {ttft} | {tokens} tokens, {tps or 0:.1f} tok/s | {total:.2f}s total]")
+
+def repl(base_model, adapters_dir, max_tokens=256, temp=0.7, ngl=None):
+    """Prompt loop on one llama-server: the base model loads once, adapters switch in memory."""
+    adapters = list_adapters(adapters_dir)
+    bad = test_gguf.incompatible_adapters(base_model, [p for _, p in adapters]) if adapters else []
+    adapters = [(name, path) for name, path in adapters if os.path.abspath(path) not in bad]
+    by_name = {os.path.splitext(name)[0].lower(): path for name, path in adapters}
+    if ngl is None:
+        ngl = 35 if test_gguf.has_gpu() else 0
+
+    def resolve(name):
+        path = by_name.get(os.path.splitext(name)[0].lower())
+        if not path:
+            print(f"✗ Unknown adapter: {name} (see :list)")
+        return path
+
+    try:
+        server = llama_server.LlamaServer(base_model, [p for _, p in adapters], ngl=ngl).start()
+    except RuntimeError as e:
+        print(f"✗ {e}")
+        return False
+
+    active = {}
+    try:
+        print(f"\nBase model and {len(adapters)} adapter(s) loaded in {server.load_seconds:.1f}s")
+        print(REPL_HELP)
+        while True:
+            label = " + ".join(f"{os.path.basename(p)}@{s:g}" for p, s in active.items()) or "base"
+            try:
+                line = input(f"\n[{label}]> ").strip()
+            except (EOFError, KeyboardInterrupt):
+                print()
+                break
+            if not line:
+                continue
+            if not line.startswith(":"):
+                stream_prompt(server, line, max_tokens, temp)
+                continue
+
+            words = line[1:].split()
+            if not words:
+                print("✗ Missing command after ':' (:help for commands)")
+                continue
+            cmd, *rest = words
+            new = None
+            if cmd in ("q", "quit", "exit"):
+                break
+            elif cmd == "help":
+                print(REPL_HELP)
+            elif cmd == "list":
+                for name, path in adapters:
+                    scale = active.get(os.path.abspath(path))
+                    print(f"  {'*' if scale else ' '} {name}" + (f"  (scale {scale:g})" if scale else ""))
+            elif cmd == "base":
+                new = {}
+            elif cmd == "adapter" and rest:
+                path = resolve(rest[0])
+                try:
+                    new = {path: float(rest[1]) if len(rest) > 1 else 1.0} if path else None
+                except ValueError:
+                    print(f"✗ Bad scale: {rest[1]}")
+            elif cmd == "blend" and rest:
+                weighted = [(resolve(name), w) for name, w in map(parse_weighted, rest)]
+                new = dict(weighted) if all(p for p, _ in weighted) else None
+            elif cmd in ("temp", "max") and rest:
+                try:
+                    if cmd == "temp":
+                        temp = float(rest[0])
+                    else:
+                        max_tokens = int(rest[0])
+                except ValueError:
+                    print(f"✗ Bad value: {rest[0]}")
+            else:
+                print(f"✗ Unknown command: {line} (:help for commands)")
+
+            if new is not None:
+                start = time.perf_counter()
+                try:
+                    server.set_adapters(new)
+                except (urllib.error.URLError, OSError, ValueError) as e:
+                    print(f"✗ Switch failed, still on {label}: {e}")
+                    continue
+                active = {os.path.abspath(p): s for p, s in new.items()}
+                print(f"Switched in {(time.perf_counter() - start) * 1000:.0f} ms")
+    finally:
+        server.stop()
+    return True
+
+def interactive_menu(base_model, adapters_dir, prompt, max_tokens, temp, ngl, backend="cli"):
     """Interactive menu to select and test adapters."""
     adapters = list_adapters(adapters_dir)
     
@@ -75,6 +254,7 @@ def interactive_menu(base_model, adapters_dir, prompt, max_tokens, temp, ngl):
             
             print(f"\n  [{len(adapters)+2}] Test ALL adapters sequentially")
         
+        print("  [r] Prompt session (model stays loaded, switch adapters in memory)")
         print("  [q] Quit")
         
         choice = input("\nSelect option: ").strip().lower()
@@ -82,29 +262,29 @@ def interactive_menu(base_model, adapters_dir, prompt, max_tokens, temp, ngl):
         if choice == 'q':
             print("\nExiting...")
             break
+        elif choice == 'r':
+            repl(base_model, adapters_dir, max_tokens, temp, ngl)
         elif choice == '0':
-            run_test(base_model, None, prompt, max_tokens, temp, ngl)
+            run_test(base_model, None, prompt, max_tokens, temp, ngl, backend)
         elif choice == '1':
             b2_path = os.path.join(adapters_dir, "B2.gguf")
             if os.path.exists(b2_path):
-                run_test(base_model, b2_path, prompt, max_tokens, temp, ngl)
+                run_test(base_model, b2_path, prompt, max_tokens, temp, ngl, backend)
             else:
                 print(f"\n✗ B2.gguf not found at {b2_path}")
         elif adapters and choice.isdigit():
             idx = int(choice)
             if 2 <= idx <= len(adapters) + 1:
                 name, path = adapters[idx - 2]
-                run_test(base_model, path, prompt, max_tokens, temp, ngl)
+                run_test(base_model, path, prompt, max_tokens, temp, ngl, backend)
             elif idx == len(adapters) + 2:
-                print(f"\nTesting all {len(adapters)} adapters sequentially...")
-                for name, path in adapters:
-                    run_test(base_model, path, prompt, max_tokens, temp, ngl)
+                run_all(base_model, adapters_dir, prompt, max_tokens, temp, ngl, backend)
             else:
                 print("\n✗ Invalid option")
         else:
             print("\n✗ Invalid option")
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Interactive adapter switcher for testing",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -125,6 +305,21 @@ Examples:
   # Test all adapters
   python /app/scripts/switch_adapter.py --all
 
+  # Test all adapters on one persistent llama-server (base model loaded once)
+  python /app/scripts/switch_adapter.py --all --backend server
+
+  # Benchmark base model and all adapters on CPU (tokens/s, TTFT, peak RSS -> /workspace/bench)
+  python /app/scripts/switch_adapter.py --all --bench --bench-threads 4,8
+
+  # Route the prompt to the best-matching adapter(s) and run only those
+  python /app/scripts/switch_adapter.py --auto --top-k 2 --prompt "How are finance leases classified?"
+
+  # Prompt session: base model loaded once, adapters switched in memory
+  python /app/scripts/switch_adapter.py --repl
+
+  # Speculative decoding with a small draft model vs. plain decoding (acceptance rate, tok/s)
+  python /app/scripts/switch_adapter.py --adapter B2 --draft-model /workspace/models/draft.Q4_K_M.gguf
+
   # Custom prompt
   python /app/scripts/switch_adapter.py --adapter B2 --prompt "What is financial risk?"
         """
@@ -139,8 +334,23 @@ Examples:
     parser.add_argument("--max-tokens", type=int, default=256, help="Max tokens to generate")
     parser.add_argument("--temp", type=float, default=0.7, help="Sampling temperature")
     parser.add_argument("--ngl", type=int, help="GPU offload layers (set 0 for CPU)")
+    parser.add_argument("--backend", choices=["cli", "server"], default="cli",
+                        help="cli: one llama-cli run per test; server: one llama-server, adapters switched via /lora-adapters")
+    parser.add_argument("--draft-model", help="Small draft GGUF: compare speculative decoding with plain decoding")
+    parser.add_argument("--draft-max", type=int, default=16, help="Max tokens drafted per step with --draft-model")
+    parser.add_argument("--repl", action="store_true",
+                        help="Interactive prompt session on one llama-server (model loaded once, :adapter/:blend/:base to switch)")
+    parser.add_argument("--auto", action="store_true", help="Pick the adapter(s) for the prompt with the BM25 router (adapter_router.py)")
+    parser.add_argument("--top-k", type=int, default=1, help="Adapters blended by --auto")
+    parser.add_argument("--bench", action="store_true", help="Benchmark the selection (base, --adapter or --all) instead of printing output")
+    parser.add_argument("--bench-threads", help="Comma-separated thread counts for --bench (default: all cores)")
+    parser.add_argument("--bench-ngl", help="Comma-separated GPU offload layers for --bench (default: --ngl, else 0)")
+    parser.add_argument("--bench-ctx", default="2048", help="Comma-separated context sizes for --bench")
+    parser.add_argument("--bench-repeats", type=int, default=3, help="Repeats of the prompt suite for --bench")
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    bench = dict(ngl=args.bench_ngl or args.ngl, threads=args.bench_threads, ctx=args.bench_ctx,
+                 repeats=args.bench_repeats, max_tokens=args.max_tokens)
     
     # Validate base model exists
     if not os.path.exists(args.model):
@@ -149,7 +359,10 @@ Examples:
     
     # Handle different modes
     if args.base_only:
-        return 0 if run_test(args.model, None, args.prompt, args.max_tokens, args.temp, args.ngl) else 1
+        if args.bench:
+            return 0 if run_bench(args.model, [], **bench) else 1
+        return 0 if run_test(args.model, None, args.prompt, args.max_tokens, args.temp, args.ngl, args.backend,
+                             args.draft_model, args.draft_max) else 1
     
     elif args.adapter:
         # Find adapter by name (with or without .gguf extension)
@@ -167,7 +380,10 @@ Examples:
                 print(f"  • {name}")
             return 1
         
-        return 0 if run_test(args.model, adapter_path, args.prompt, args.max_tokens, args.temp, args.ngl) else 1
+        if args.bench:
+            return 0 if run_bench(args.model, [adapter_path], **bench) else 1
+        return 0 if run_test(args.model, adapter_path, args.prompt, args.max_tokens, args.temp, args.ngl, args.backend,
+                             args.draft_model, args.draft_max) else 1
     
     elif args.all:
         adapters = list_adapters(args.adapters_dir)
@@ -175,17 +391,25 @@ Examples:
             print(f"✗ No adapters found in {args.adapters_dir}")
             return 1
         
-        print(f"\nTesting all {len(adapters)} adapters sequentially...\n")
-        success = True
-        for name, path in adapters:
-            if not run_test(args.model, path, args.prompt, args.max_tokens, args.temp, args.ngl):
-                success = False
-        
-        return 0 if success else 1
+        if args.bench:
+            return 0 if run_bench(args.model, [path for _, path in adapters], **bench) else 1
+        return 0 if run_all(args.model, args.adapters_dir, args.prompt, args.max_tokens, args.temp, args.ngl, args.backend,
+                            args.draft_model, args.draft_max) else 1
+    
+    elif args.repl:
+        return 0 if repl(args.model, args.adapters_dir, args.max_tokens, args.temp, args.ngl) else 1
+    
+    elif args.auto:
+        return 0 if run_auto(args.model, args.adapters_dir, args.prompt, args.max_tokens, args.temp,
+                             args.ngl, args.backend, args.top_k) else 1
+    
+    elif args.bench:
+        print("✗ --bench needs --base-only, --adapter or --all")
+        return 1
     
     else:
         # Interactive mode
-        interactive_menu(args.model, args.adapters_dir, args.prompt, args.max_tokens, args.temp, args.ngl)
+        interactive_menu(args.model, args.adapters_dir, args.prompt, args.max_tokens, args.temp, args.ngl, args.backend)
         return 0
 
 if __name__ == "__main__":
@@ -2,6 +2,14 @@ import argparse
 import subprocess
 import os
 import shlex
+import sys
+import time
+import urllib.error
+
+import adapter_router
+import gguf_catalog
+import llama_server
+import response_cache
 
 DEFAULT_PROMPT = "Explain the importance of liquidity risk management in banking."
 
@@ -27,15 +35,38 @@ def has_gpu():
         return False
 
 def list_adapters(adapters_dir):
-    if not adapters_dir or not os.path.isdir(adapters_dir):
-        return []
     out = []
-    for name in sorted(os.listdir(adapters_dir)):
-        if name.lower().endswith(".gguf"):
-            out.append(os.path.join(adapters_dir, name))
+    for entry in gguf_catalog.scan_dir(adapters_dir):
+        if not entry["valid"]:
+            print(f"Skipping {entry['name']}: {entry['error']}")
+            continue
+        out.append(entry["path"])
     return out
 
-def run_inference(binary, model, prompt, max_tokens, temp, ngl, adapter=None):
+def incompatible_adapters(model, adapters):
+    """Check adapters against the model's GGUF tensor table before any model load.
+
+    Returns the absolute paths of unusable adapters, missing files included.
+    """
+    if not os.path.isfile(model):
+        print(f"Error: Model file not found at {model}")
+        return [os.path.abspath(a) for a in adapters]
+    bad = []
+    for adapter in adapters:
+        if not os.path.isfile(adapter):
+            print(f"Skipping {os.path.basename(adapter)}: not found at {adapter}")
+            bad.append(os.path.abspath(adapter))
+    base_entry = gguf_catalog.refresh([model])[0]
+    for entry in gguf_catalog.refresh([a for a in adapters if os.path.abspath(a) not in bad]):
+        problems = gguf_catalog.check_compat(entry, base_entry)
+        if problems:
+            print(f"Skipping {entry['name']}: incompatible with {os.path.basename(model)}")
+            for problem in problems:
+                print(f"  - {problem}")
+            bad.append(entry["path"])
+    return bad
+
+def run_inference(binary, model, prompt, max_tokens, temp, ngl, adapter=None, seed=None, capture=False, scaled=None):
     cmd = [
         binary,
         "-m", model,
@@ -47,14 +78,100 @@ def run_inference(binary, model, prompt, max_tokens, temp, ngl, adapter=None):
         cmd += ["-ngl", str(ngl)]
     if adapter:
         cmd += ["--lora", adapter]
+    for path, scale in scaled or []:
+        cmd += ["--lora-scaled", path, f"{scale:g}"]
+    if seed is not None:
+        cmd += ["--seed", str(seed)]
 
     print(f"Running inference with model: {model}")
     if adapter:
         print(f"Using adapter: {adapter}")
+    for path, scale in scaled or []:
+        print(f"Using adapter: {path} (scale {scale:.2f})")
     print(f"Command: {' '.join(shlex.quote(c) for c in cmd)}")
-    subprocess.run(cmd, check=True)
+    if not capture:
+        subprocess.run(cmd, check=True)
+        return None
+    output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+    print(output)
+    return output
+
+def cache_key(cache, backend, model, adapter, prompt, max_tokens, temp, ngl, seed):
+    """Key for one run; adapter is a path, None for the base model, or [(path, scale), ...]."""
+    params = {"backend": backend, "max_tokens": max_tokens, "temp": temp, "ngl": ngl}
+    scaled = adapter if isinstance(adapter, list) else [(adapter, 1.0)] if adapter else []
+    return cache.key(model, scaled, prompt, params, seed)
+
+def cached_inference(cache, binary, model, prompt, max_tokens, temp, ngl, adapter=None, seed=None):
+    """run_inference, answered from the response cache when this exact run was seen before."""
+    key = cache_key(cache, "llama-cli", model, adapter, prompt, max_tokens, temp, ngl, seed)
+    hit = cache.get(key)
+    if hit is not None:
+        print(f"Cached response for {os.path.basename(adapter) if adapter else 'base model'}:")
+        print(hit["content"])
+        return
+    output = run_inference(binary, model, prompt, max_tokens, temp, ngl, adapter, seed, capture=key is not None)
+    if output and output.strip():
+        cache.put(key, {"content": output})
+
+def cached_sweep(cache, model, adapters, prompt, max_tokens, temp, ngl, seed):
+    """Server sweep that only starts llama-server for runs missing from the response cache."""
+    runs = list(adapters) or [None]
+    hits = {}
+    for adapter in runs:
+        hit = cache.get(cache_key(cache, "llama-server", model, adapter, prompt, max_tokens, temp, ngl, seed))
+        if hit is not None:
+            hits[adapter] = hit
+            print(f"Cached response for {os.path.basename(adapter) if adapter else 'base model'}:")
+            print(hit["content"])
+
+    missing = [a for a in runs if a not in hits]
+    if not missing:
+        return True
+    results = llama_server.sweep(
+        model, [a for a in missing if a], prompt, max_tokens, temp, ngl,
+        include_base=None in missing, seed=seed,
+    )
+    for adapter, row in zip(missing, results):
+        if row["ok"]:
+            key = cache_key(cache, "llama-server", model, adapter, prompt, max_tokens, temp, ngl, seed)
+            cache.put(key, {"content": row["content"]})
+    return all(r["ok"] for r in results)
 
-def main():
+def route_adapters(prompt, adapters, top_k=1):
+    """Pick [(adapter_path, weight), ...] for the prompt among the given GGUF adapters."""
+    by_name = {os.path.splitext(os.path.basename(a))[0]: a for a in adapters}
+    index = adapter_router.load_index()
+    start = time.perf_counter()
+    routed = adapter_router.route(index, prompt, top_k, allowed=set(by_name))
+    print(f"Routed in {(time.perf_counter() - start) * 1000:.1f} ms: "
+          + (", ".join(f"{name} ({weight:.2f})" for name, weight in routed) or "no match, base model"))
+    return [(by_name[name], weight) for name, weight in routed]
+
+def run_routed(binary, model, routed, prompt, max_tokens, temp, ngl, seed=None, backend="cli", cache=None):
+    """One generation with the routed adapter(s); several are applied together at their weights."""
+    key = cache_key(cache, f"llama-{backend}", model, routed, prompt, max_tokens, temp, ngl, seed) if cache else None
+    hit = cache.get(key) if cache else None
+    if hit is not None:
+        print("Cached response:")
+        print(hit["content"])
+        return True
+
+    if backend == "server":
+        with llama_server.LlamaServer(model, [p for p, _ in routed], ngl=ngl) as server:
+            server.set_adapters(dict(routed))
+            params = {} if seed is None else {"seed": seed}
+            output = server.complete(prompt, max_tokens=max_tokens, temp=temp, **params).get("content", "")
+        print(output if output.strip() else "✗ Empty output")
+    else:
+        single = routed[0][0] if len(routed) == 1 else None
+        output = run_inference(binary, model, prompt, max_tokens, temp, ngl, adapter=single, seed=seed,
+                               capture=True, scaled=routed if len(routed) > 1 else None)
+    if cache and output.strip():
+        cache.put(key, {"content": output})
+    return bool(output.strip())
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Test a GGUF model.")
     parser.add_argument("model", help="Path to the .gguf model file")
     parser.add_argument("--prompt", default=DEFAULT_PROMPT, help="Test prompt")
@@ -63,43 +180,149 @@ def main():
     parser.add_argument("--max-tokens", type=int, default=256, help="Max tokens to generate")
     parser.add_argument("--temp", type=float, default=0.7, help="Sampling temperature")
     parser.add_argument("--ngl", type=int, default=35, help="GPU offload layers (set 0 for CPU)")
-    args = parser.parse_args()
+    parser.add_argument("--backend", choices=["cli", "server"], default="cli",
+                        help="cli: one llama-cli run per adapter; server: one llama-server with all adapters preloaded")
+    parser.add_argument("--auto", action="store_true",
+                        help="Route the prompt to the best-matching adapter(s) in --adapters-dir (default v3) and run only those; see adapter_router.py")
+    parser.add_argument("--top-k", type=int, default=1, help="Adapters blended by --auto (weights from the router scores)")
+    parser.add_argument("--seed", type=int, help="Sampling seed (a fixed seed makes runs cacheable at temp > 0)")
+    parser.add_argument("--cache", action="store_true",
+                        help="Reuse stored outputs for identical deterministic runs (temp 0 or fixed --seed)")
+    parser.add_argument("--draft-model", help="Small draft GGUF (same tokenizer): compare speculative decoding against plain decoding")
+    parser.add_argument("--draft-max", type=int, default=16, help="Max tokens drafted per step with --draft-model")
+    parser.add_argument("--bench", action="store_true",
+                        help="Benchmark instead of printing output (see bench_gguf.py; CPU-only unless --bench-ngl is set)")
+    parser.add_argument("--bench-threads", default=str(os.cpu_count() or 4), help="Comma-separated thread counts for --bench")
+    parser.add_argument("--bench-ngl", default="0", help="Comma-separated GPU offload layers for --bench")
+    parser.add_argument("--bench-ctx", default="2048", help="Comma-separated context sizes for --bench")
+    parser.add_argument("--bench-repeats", type=int, default=3, help="Repeats of the prompt suite for --bench")
+    args = parser.parse_args(argv)
 
-    binary = find_binary()
-    if not binary:
-        print("Error: llama-cli or main binary not found in /workspace/llama.cpp/build/bin/")
-        return
+    if args.bench:
+        # Imported here: bench_gguf imports this module
+        import bench_gguf
+
+        cmd = ["--models", args.model, "--threads", args.bench_threads, "--ngl", args.bench_ngl,
+               "--ctx", args.bench_ctx, "--repeats", str(args.bench_repeats), "--max-tokens", str(args.max_tokens)]
+        if args.adapter:
+            cmd += ["--adapters", args.adapter]
+        if args.adapters_dir:
+            cmd += ["--adapters-dir", args.adapters_dir]
+        return bench_gguf.main(cmd)
 
     if not os.path.exists(args.model):
         print(f"Error: Model file not found at {args.model}")
-        return
+        return 1
 
     if args.adapter and args.adapters_dir:
         print("Error: use either --adapter or --adapters-dir, not both")
-        return
+        return 1
 
     if args.ngl and args.ngl > 0 and not has_gpu():
         print("GPU not detected; forcing -ngl 0 for CPU.")
         args.ngl = 0
 
+    if args.auto and not args.adapter and not args.adapters_dir:
+        args.adapters_dir = gguf_catalog.DEFAULT_ADAPTERS_DIR
+
+    if args.adapters_dir:
+        adapters = list_adapters(args.adapters_dir)
+        bad = incompatible_adapters(args.model, adapters)
+        adapters = [a for a in adapters if os.path.abspath(a) not in bad]
+        if not adapters:
+            print(f"No usable .gguf adapters found in {args.adapters_dir}")
+            return 1
+    else:
+        if args.adapter and incompatible_adapters(args.model, [args.adapter]):
+            return 1
+        adapters = [args.adapter] if args.adapter else []
+
+    if args.draft_model:
+        # Imported here: speculative imports bench_gguf, which imports this module
+        import speculative
+
+        spec_binary = speculative.find_speculative_binary()
+        cli_binary = find_binary()
+        if not spec_binary or not cli_binary:
+            print("Error: llama-speculative and llama-cli binaries are both needed in /workspace/llama.cpp/build/bin/")
+            return 1
+        if not os.path.exists(args.draft_model):
+            print(f"Error: Draft model not found at {args.draft_model}")
+            return 1
+        rows = speculative.compare(
+            cli_binary, spec_binary, args.model, args.draft_model, adapters or [None],
+            args.prompt, args.max_tokens, args.draft_max, args.ngl,
+        )
+        return 0 if all(r["ok"] for r in rows) else 1
+
+    binary = find_binary() if args.backend == "cli" else llama_server.find_server_binary()
+    if not binary:
+        name = "llama-cli or main" if args.backend == "cli" else "llama-server"
+        print(f"Error: {name} binary not found in /workspace/llama.cpp/build/bin/")
+        return 1
+
+    cache = None
+    if args.cache:
+        if response_cache.is_deterministic(args.temp, args.seed):
+            cache = response_cache.ResponseCache()
+        else:
+            print("Response cache skipped: needs --temp 0 or a fixed --seed")
+
+    if args.auto:
+        try:
+            routed = route_adapters(args.prompt, adapters, args.top_k)
+            ok = run_routed(binary, args.model, routed, args.prompt, args.max_tokens, args.temp,
+                            args.ngl, args.seed, args.backend, cache)
+        except (RuntimeError, subprocess.CalledProcessError, urllib.error.URLError, OSError) as e:
+            print(f"Inference failed: {e}")
+            return 1
+        finally:
+            if cache:
+                cache.report()
+                cache.close()
+        return 0 if ok else 1
+
+    if args.backend == "server":
+        try:
+            if cache:
+                ok = cached_sweep(cache, args.model, adapters, args.prompt, args.max_tokens,
+                                  args.temp, args.ngl, args.seed)
+            else:
+                results = llama_server.sweep(
+                    args.model, adapters, args.prompt, args.max_tokens, args.temp,
+                    args.ngl, include_base=not adapters, seed=args.seed,
+                )
+                ok = all(r["ok"] for r in results)
+        except (RuntimeError, urllib.error.URLError, OSError) as e:
+            print(f"Inference failed: {e}")
+            return 1
+        finally:
+            if cache:
+                cache.report()
+                cache.close()
+        return 0 if ok else 1
+
     try:
-        if args.adapters_dir:
-            adapters = list_adapters(args.adapters_dir)
-            if not adapters:
-                print(f"No .gguf adapters found in {args.adapters_dir}")
-                return
-            for adapter in adapters:
+        for adapter in adapters or [None]:
+            if cache:
+                cached_inference(
+                    cache, binary, args.model, args.prompt, args.max_tokens,
+                    args.temp, args.ngl, adapter=adapter, seed=args.seed
+                )
+            else:
                 run_inference(
                     binary, args.model, args.prompt, args.max_tokens,
-                    args.temp, args.ngl, adapter=adapter
+                    args.temp, args.ngl, adapter=adapter, seed=args.seed
                 )
-        else:
-            run_inference(
-                binary, args.model, args.prompt, args.max_tokens,
-                args.temp, args.ngl, adapter=args.adapter
-            )
     except subprocess.CalledProcessError as e:
         print(f"Inference failed: {e}")
+        return 1
+    finally:
+        if cache:
+            cache.report()
+            cache.close()
+
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,29 +1,34 @@
 import argparse
+import gc
+import json
 import os
-from datasets import load_dataset
-from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    BitsAndBytesConfig,
-)
-from peft import LoraConfig, get_peft_model
-from trl import SFTTrainer, SFTConfig
+import time
+
+import archive_manifest
+from gguf_catalog import file_sha256
 from lora_layer_config import load_lora_config
 
 HF_MODEL_DIR = "/workspace/models/hf_mistral"
 DATA_PATH = "/workspace/data/processed/train.jsonl"
 
 
-def parse_args():
+def parse_args(argv=None):
     ap = argparse.ArgumentParser()
     ap.add_argument("--lora_name", required=True)
     ap.add_argument("--max_steps", type=int, default=200)
     ap.add_argument("--max_seq_length", type=int, default=512)
-    return ap.parse_args()
+    return ap.parse_args(argv)
+
 
+def main(argv=None):
+    # Heavy imports stay inside main() so the control center only pays for them when training
+    import torch
+    from datasets import load_dataset
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+    from trl import SFTConfig, SFTTrainer
 
-def main():
-    args = parse_args()
+    args = parse_args(argv)
 
     cfg = load_lora_config(args.lora_name)
     out_dir = f"/workspace/peft/{args.lora_name}"
@@ -92,8 +97,24 @@ def main():
     trainer.model.save_pretrained(out_dir)
     tokenizer.save_pretrained(out_dir)
 
+    # What this adapter was trained on, for adapter_router's index
+    with open(os.path.join(out_dir, "provenance.json"), "w") as f:
+        json.dump({
+            "trained": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "lora_name": args.lora_name,
+            "dataset": {"path": DATA_PATH, "sha256": file_sha256(DATA_PATH)},
+            "documents": archive_manifest.load_consumed(),
+        }, f, indent=2)
+    archive_manifest.mark_trained()
+
     print(f"Training complete → {out_dir}")
 
+    # Release the 4-bit model and optimizer state when called in-process
+    del trainer, model
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
 
 if __name__ == "__main__":
     main()
@@ -2,9 +2,12 @@
 """
 Quick verification script to check adapter files and test setup.
 """
+import argparse
 import os
 import sys
 
+import gguf_catalog
+
 def check_file(path, description):
     """Check if a file/directory exists and report its status."""
     if os.path.exists(path):
@@ -21,35 +24,79 @@ def check_file(path, description):
         return False
 
 def list_gguf_adapters(adapters_dir):
-    """List all .gguf files in the adapters directory."""
+    """Catalog entries for all .gguf files in the adapters directory."""
     if not os.path.isdir(adapters_dir):
         print(f"\n✗ Adapters directory not found: {adapters_dir}")
         return []
     
-    adapters = []
-    for name in sorted(os.listdir(adapters_dir)):
-        if name.lower().endswith(".gguf"):
-            full_path = os.path.join(adapters_dir, name)
-            size = os.path.getsize(full_path) / (1024 * 1024)  # MB
-            adapters.append((name, full_path, size))
-    
-    return adapters
+    return gguf_catalog.scan_dir(adapters_dir)
+
+def check_adapters(adapters, base_model, checksums=True, workers=None):
+    """
+    Flag adapters that cannot be applied to the base model or whose content
+    no longer matches the hash recorded for them. Returns names of bad adapters.
+    """
+    base_entry = gguf_catalog.refresh([base_model])[0] if os.path.isfile(base_model) else None
+    if base_entry is None:
+        print("\n✗ Base model not found; skipping compatibility checks")
+    elif not base_entry["valid"]:
+        print(f"\n✗ Base model unreadable: {base_entry['error']}")
+        base_entry = None
+    else:
+        print(f"\nBase: {base_entry['model_name']} ({base_entry['architecture']}, "
+              f"hidden size {base_entry.get('hidden_size')}, {base_entry['tensor_count']} tensors)")
+
+    hashes = {}
+    if checksums:
+        print(f"Verifying checksums of {len(adapters)} adapter(s)...")
+        hashes = gguf_catalog.verify_hashes([a["path"] for a in adapters], workers=workers)
+
+    bad = []
+    print()
+    for adapter in adapters:
+        problems = []
+        if base_entry is not None:
+            problems = gguf_catalog.check_compat(adapter, base_entry)
+        elif not adapter["valid"]:
+            problems = [adapter["error"]]
+
+        status, _ = hashes.get(adapter["path"], (None, None))
+        if status == "mismatch":
+            problems.append("checksum mismatch: content changed since it was recorded (corrupt file?)")
+
+        if problems:
+            bad.append(adapter["name"])
+            print(f"  ✗ {adapter['name']}")
+            for problem in problems:
+                print(f"      - {problem}")
+        else:
+            note = {"ok": "checksum ok", "recorded": "checksum recorded"}.get(status, "checksum skipped")
+            print(f"  ✓ {adapter['name']:34s} compatible, {note}")
+
+    return bad
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify adapter files and test setup.")
+    parser.add_argument("--base-model", default="/workspace/models/mistral-7b-instruct-v0.2.Q4_K_M.gguf", help="Base GGUF model")
+    parser.add_argument("--adapters-dir", default="/workspace/output/adapters_gguf/v3", help="Directory containing GGUF adapters")
+    parser.add_argument("--no-checksum", action="store_true", help="Skip re-hashing adapter files")
+    parser.add_argument("--workers", type=int, help="Parallel checksum workers")
+    args = parser.parse_args(argv)
 
-def main():
     print("=" * 60)
     print("ADAPTER VERIFICATION REPORT")
     print("=" * 60)
     
     # Check base model
-    base_model = "/workspace/models/mistral-7b-instruct-v0.2.Q4_K_M.gguf"
+    base_model = args.base_model
     base_exists = check_file(base_model, "Base model")
     
     # Check B2 adapter specifically
-    b2_adapter = "/workspace/output/adapters_gguf/v3/B2.gguf"
+    b2_adapter = os.path.join(args.adapters_dir, "B2.gguf")
     b2_exists = check_file(b2_adapter, "B2 adapter")
     
     # Check adapters directory
-    adapters_dir = "/workspace/output/adapters_gguf/v3"
+    adapters_dir = args.adapters_dir
     adapters_dir_exists = check_file(adapters_dir, "Adapters directory")
     
     # List all GGUF adapters
@@ -60,15 +107,24 @@ def main():
     if adapters_dir_exists:
         adapters = list_gguf_adapters(adapters_dir)
         if adapters:
-            print(f"\nFound {len(adapters)} adapter(s):\n")
-            for name, path, size in adapters:
-                print(f"  • {name:30s} ({size:7.2f} MB)")
+            invalid = [a for a in adapters if not a["valid"]]
+            print(f"\nFound {len(adapters)} adapter(s), {len(invalid)} invalid:\n")
+            gguf_catalog.print_entries(adapters)
         else:
             print("\n✗ No .gguf files found in adapters directory")
             print("  (Directory exists but is empty or contains non-GGUF files)")
     else:
+        adapters = []
         print("\n✗ Cannot list adapters - directory not found")
     
+    # Check adapters against the base model's tensor table and recorded checksums
+    bad_adapters = []
+    if adapters:
+        print("\n" + "=" * 60)
+        print("COMPATIBILITY & INTEGRITY:")
+        print("=" * 60)
+        bad_adapters = check_adapters(adapters, base_model, checksums=not args.no_checksum, workers=args.workers)
+    
     # Check test binary
     print("\n" + "=" * 60)
     print("TEST INFRASTRUCTURE:")
@@ -116,9 +172,13 @@ def main():
         if not binary_found:
             print("  → Test binary not found. May need to rebuild llama.cpp.")
     
+    if bad_adapters:
+        print(f"✗ {len(bad_adapters)} adapter(s) are incompatible or corrupt: {', '.join(bad_adapters)}")
+        print("  → Re-export them from PEFT against this base model before testing.")
+    
     print("=" * 60)
     
-    return 0 if all_ready else 1
+    return 0 if all_ready and not bad_adapters else 1
 
 if __name__ == "__main__":
     sys.exit(main())